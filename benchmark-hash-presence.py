@@ -0,0 +1,423 @@
+#! /usr/bin/env python
+"""
+Benchmark the hash presence scripts and library on synthetic data, and
+compare the timings against earlier runs recorded in a history file.
+"""
+import sys
+import os
+import argparse
+import contextlib
+import csv
+import io
+import json
+import bisect
+import platform
+import subprocess
+import tempfile
+import time
+
+import numpy
+import sklearn.cluster
+import sourmash
+from sourmash import sourmash_args
+from sourmash.minhash import _get_max_hash_for_scaled
+
+# only use library functions that exist in every version, so that the
+# benchmarks can be run against older trees; see the README.
+from hash_presence_lib import HashPresenceInformation
+
+
+# n_samples, n_hashes, density and number of hashes in the association
+# matrix / clustering benchmarks, for --size.
+SIZES = {
+    'small': dict(n_samples=100, n_hashes=5_000, density=0.1,
+                  matrix_hashes=1_000),
+    'medium': dict(n_samples=1_000, n_hashes=20_000, density=0.1,
+                   matrix_hashes=4_000),
+    'large': dict(n_samples=5_000, n_hashes=100_000, density=0.05,
+                  matrix_hashes=10_000),
+}
+
+BENCHMARKS = ('scan', 'save', 'load', 'downsample', 'filter',
+              'association_matrix', 'presence_matrix', 'cluster')
+
+
+#
+# synthetic data
+#
+
+def make_presence_info(*, n_samples, n_hashes, density, n_modules=20,
+                       core_fraction=0.1, scaled=1000, ksize=21, seed=1):
+    """
+    Build synthetic presence information with pangenome-like structure.
+
+    A 'core_fraction' of the hashes is present in almost every sample; the
+    rest are split into 'n_modules' modules (think accessory genes), and
+    each sample carries each module with a probability chosen so that
+    about 'density' of the accessory hash x sample pairs are present.
+    Hashes are classified into pangenome ranks by how many samples they
+    are in.
+
+    Returns the presence information, its hashval => set of sample names
+    dictionary, and a dictionary of sample name => array of hashes.
+    """
+    rng = numpy.random.default_rng(seed)
+    max_hash = _get_max_hash_for_scaled(scaled)
+    hashvals = numpy.unique(rng.integers(1, max_hash, size=n_hashes,
+                                         dtype=numpy.uint64))
+    rng.shuffle(hashvals)
+
+    n_core = int(len(hashvals) * core_fraction)
+    module = numpy.full(len(hashvals), -1)
+    module[n_core:] = rng.integers(0, n_modules, size=len(hashvals) - n_core)
+
+    carry = rng.random((n_modules, n_samples)) < min(density / 0.9, 1)
+    hashes = []
+    sample_idx = []
+    for m in range(-1, n_modules):
+        members = hashvals[module == m]
+        if m < 0:
+            samples = numpy.arange(n_samples)
+            p_present = 0.95
+        else:
+            samples = numpy.flatnonzero(carry[m])
+            p_present = 0.9
+        present = rng.random((len(members), len(samples))) < p_present
+        rows, cols = numpy.nonzero(present)
+        hashes.append(members[rows])
+        sample_idx.append(samples[cols])
+
+    hashes = numpy.concatenate(hashes)
+    sample_idx = numpy.concatenate(sample_idx)
+    sample_names = [ f"sample{n}" for n in range(n_samples) ]
+    order = numpy.argsort(sample_idx, kind='stable')
+    starts = numpy.searchsorted(sample_idx[order], numpy.arange(n_samples + 1))
+    sample_hits = { name: hashes[order[starts[n]:starts[n + 1]]]
+                    for n, name in enumerate(sample_names) }
+
+    hash_to_sample = {}
+    for name, hits in sample_hits.items():
+        for hashval in hits.tolist():
+            hash_to_sample.setdefault(hashval, set()).add(name)
+
+    # classify every hash by the fraction of samples it is in.
+    classify_d = {}
+    for hashval in hashvals.tolist():
+        frac = len(hash_to_sample.get(hashval, ())) / n_samples
+        classify_d[hashval] = 5 - bisect.bisect_right([0.1, 0.3, 0.7, 0.9],
+                                                      frac)
+
+    presence_info = make_presence_object(hash_to_sample, classify_d,
+                                         ksize=ksize, scaled=scaled)
+    return presence_info, hash_to_sample, sample_hits
+
+
+def make_presence_object(hash_to_sample, classify_d, *, ksize, scaled):
+    """
+    Create a HashPresenceInformation from a hashval => set of sample names
+    dictionary. This constructor is available in every version of the
+    library, so the benchmarks also run against older trees.
+    """
+    return HashPresenceInformation(ksize=ksize, scaled=scaled,
+                                   classify_d=classify_d,
+                                   hash_to_sample=hash_to_sample)
+
+
+def subsample_hashes(presence_info, hash_to_sample, n, *, seed=1):
+    "Keep a random subset of at most 'n' hashes of 'presence_info'."
+    rng = numpy.random.default_rng(seed)
+    hashvals = sorted(hash_to_sample)
+    if n < len(hashvals):
+        keep = rng.choice(len(hashvals), size=n, replace=False)
+        hashvals = [ hashvals[i] for i in sorted(keep) ]
+    return make_presence_object({ h: hash_to_sample[h] for h in hashvals },
+                                presence_info.classify_d,
+                                ksize=presence_info.ksize,
+                                scaled=presence_info.scaled)
+
+
+def write_ranktable(filename, presence_info):
+    "Write the rank classifications of 'presence_info' as a ranktable CSV."
+    with open(filename, 'w', newline='') as fp:
+        w = csv.writer(fp)
+        w.writerow(['hashval', 'pangenome_classification'])
+        for hashval, classify_as in sorted(presence_info.classify_d.items()):
+            w.writerow([hashval, classify_as])
+
+
+def write_sketches(filename, presence_info, sample_hits, *, n_background,
+                   seed=1):
+    """
+    Save one sketch per sample, containing the sample's hashes plus
+    'n_background' random hashes that are not in the ranktable.
+    """
+    rng = numpy.random.default_rng(seed + 1)
+    max_hash = _get_max_hash_for_scaled(presence_info.scaled)
+    mh_template = presence_info._make_minhash_obj()
+
+    with sourmash_args.SaveSignaturesToLocation(filename) as save_sig:
+        for name, hits in sample_hits.items():
+            background = rng.integers(1, max_hash, size=n_background,
+                                      dtype=numpy.uint64)
+            mh = mh_template.copy_and_clear()
+            mh.add_many(numpy.concatenate([hits, background]).tolist())
+            save_sig.add(sourmash.SourmashSignature(mh, name=name))
+
+
+#
+# benchmarks
+#
+
+def best_time(func, repeat):
+    "Run 'func' 'repeat' times; return the fastest time and the last result."
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def run_scan_benchmark(ranktable, sketches, workdir):
+    """
+    Run calc-hash-presence.py on the synthetic data, and return its wall
+    time. The whole run is timed, rather than its scanning stage, so that
+    older versions of the script without --report can be compared.
+    """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'calc-hash-presence.py')
+    start = time.perf_counter()
+    subprocess.run([sys.executable, script, ranktable, sketches,
+                    '-o', os.path.join(workdir, 'scan.dump'), '-k', '21',
+                    '--scaled', '1000'],
+                   check=True, stdout=subprocess.DEVNULL,
+                   stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def run_benchmarks(params, names, *, workdir, repeat, n_background, seed):
+    """
+    Run the benchmarks in 'names' on synthetic data of size 'params'.
+    Returns a dictionary of name => dict(seconds, items, unit, rate).
+    """
+    print(f"generating synthetic data: {params['n_samples']} samples, {params['n_hashes']} hashes, density {params['density']}")
+    with contextlib.redirect_stdout(io.StringIO()):
+        presence_info, hash_to_sample, sample_hits = make_presence_info(
+            n_samples=params['n_samples'], n_hashes=params['n_hashes'],
+            density=params['density'], seed=seed)
+        matrix_info = subsample_hashes(presence_info, hash_to_sample,
+                                       params['matrix_hashes'], seed=seed)
+    n_hashes = len(hash_to_sample)
+    n_entries = sum(map(len, hash_to_sample.values()))
+    print(f"... {n_hashes} hashes present, {n_entries} hash x sample entries")
+
+    dump = os.path.join(workdir, 'bench.dump')
+    n_matrix = min(n_hashes, params['matrix_hashes'])
+    results = {}
+
+    def record(name, seconds, items, unit):
+        results[name] = dict(seconds=round(seconds, 4), items=items,
+                             unit=unit,
+                             rate=round(items / seconds, 1) if seconds else None)
+        print(f"\t{name}: {seconds:.3f}s ({items} {unit})")
+
+    for name in names:
+        # the library prints progress messages; keep the output readable.
+        with contextlib.redirect_stdout(io.StringIO()):
+            if name == 'scan':
+                # name the data by its parameters, so --data-dir can be reused.
+                prefix = os.path.join(workdir, f"bench.{params['n_samples']}x{params['n_hashes']}.d{params['density']}.bg{n_background}.s{seed}")
+                ranktable = prefix + '.ranktable.csv'
+                sketches = prefix + '.sigs.zip'
+                if not os.path.exists(sketches):
+                    write_ranktable(ranktable, presence_info)
+                    write_sketches(sketches, presence_info, sample_hits,
+                                   n_background=n_background, seed=seed)
+                seconds = min(run_scan_benchmark(ranktable, sketches, workdir)
+                              for _ in range(repeat))
+                items, unit = len(sample_hits), 'signatures'
+            elif name == 'save':
+                seconds, _ = best_time(lambda: presence_info.save_to_file(dump),
+                                       repeat)
+                items, unit = n_entries, 'entries'
+            elif name == 'load':
+                if not os.path.exists(dump):
+                    presence_info.save_to_file(dump)
+                seconds, _ = best_time(
+                    lambda: HashPresenceInformation.load_from_file(dump),
+                    repeat)
+                items, unit = n_entries, 'entries'
+            elif name == 'downsample':
+                seconds, _ = best_time(lambda: presence_info.downsample(10_000),
+                                       repeat)
+                items, unit = n_hashes, 'hashes'
+            elif name == 'filter':
+                seconds, _ = best_time(
+                    lambda: presence_info.filter_by_min_samples(5)
+                        .filter_by_pangenome_type([3, 4]),
+                    repeat)
+                items, unit = n_hashes, 'hashes'
+            elif name == 'association_matrix':
+                seconds, _ = best_time(matrix_info.build_association_matrix,
+                                       repeat)
+                items, unit = n_matrix * (n_matrix - 1) // 2, 'pairs'
+            elif name == 'presence_matrix':
+                seconds, _ = best_time(presence_info.build_presence_matrix,
+                                       repeat)
+                items, unit = n_entries, 'entries'
+            elif name == 'cluster':
+                _, cmp = matrix_info.build_association_matrix()
+                dist = 1 - cmp
+                hdbscan = sklearn.cluster.HDBSCAN(min_cluster_size=15,
+                                                  copy=False)
+                seconds, _ = best_time(lambda: hdbscan.fit_predict(dist),
+                                       repeat)
+                items, unit = n_matrix, 'hashes'
+        record(name, seconds, items, unit)
+
+    return results
+
+
+#
+# history
+#
+
+def read_history(filename):
+    "Read the benchmark history, one JSON record per line."
+    if not os.path.exists(filename):
+        return []
+    with open(filename) as fp:
+        return [ json.loads(line) for line in fp if line.strip() ]
+
+
+def find_baseline(history, params, *, label=None):
+    "Find the most recent run with the same parameters (and label)."
+    for record in reversed(history):
+        if record['params'] != params:
+            continue
+        if label is None or record.get('label') == label:
+            return record
+    return None
+
+
+def compare_to_baseline(results, baseline, *, max_slowdown, min_seconds):
+    """
+    Compare timings against a baseline run. A benchmark regresses if it is
+    more than 'max_slowdown' times slower and more than 'min_seconds'
+    slower. Returns a list of (name, seconds, baseline_seconds, regressed).
+    """
+    comparison = []
+    for name, result in results.items():
+        if name not in baseline['results']:
+            continue
+        base = baseline['results'][name]['seconds']
+        seconds = result['seconds']
+        regressed = seconds > base * max_slowdown and \
+            seconds - base > min_seconds
+        comparison.append((name, seconds, base, regressed))
+    return comparison
+
+
+def git_commit():
+    "Return the current git commit of this repository, if there is one."
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                             cwd=os.path.dirname(os.path.abspath(__file__)),
+                             capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.stdout.strip()
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--size', choices=list(SIZES), default='small',
+                   help="preset data size (default: small)")
+    p.add_argument('--n-samples', type=int, default=None,
+                   help="number of synthetic samples (overrides --size)")
+    p.add_argument('--n-hashes', type=int, default=None,
+                   help="number of synthetic ranktable hashes (overrides --size)")
+    p.add_argument('--density', type=float, default=None,
+                   help="fraction of accessory hash x sample pairs that are present (overrides --size)")
+    p.add_argument('--matrix-hashes', type=int, default=None,
+                   help="number of hashes in the association matrix and clustering benchmarks (overrides --size)")
+    p.add_argument('--background', type=int, default=1000,
+                   help="number of extra hashes per synthetic sketch that are not in the ranktable (default: 1000)")
+    p.add_argument('--benchmarks', default=','.join(BENCHMARKS),
+                   help=f"comma-separated list of benchmarks to run (default: {','.join(BENCHMARKS)})")
+    p.add_argument('--repeat', type=int, default=3,
+                   help="report the best of this many runs (default: 3)")
+    p.add_argument('--seed', type=int, default=1)
+    p.add_argument('--data-dir', default=None,
+                   help="keep the synthetic data in this directory and reuse it (default: a temporary directory)")
+    p.add_argument('--history', default='benchmark-history.jsonl',
+                   help="append results to this JSON lines file (default: benchmark-history.jsonl)")
+    p.add_argument('--no-record', action='store_true',
+                   help="do not append the results to the history")
+    p.add_argument('--label', default=None,
+                   help="label to record with the results, e.g. 'baseline'")
+    p.add_argument('--baseline', default=None,
+                   help="compare against the most recent run with this label (default: the most recent run with the same parameters)")
+    p.add_argument('--max-slowdown', type=float, default=1.25,
+                   help="flag benchmarks that are more than this many times slower than the baseline (default: 1.25)")
+    p.add_argument('--min-seconds', type=float, default=0.05,
+                   help="ignore slowdowns smaller than this many seconds (default: 0.05)")
+    args = p.parse_args()
+
+    names = args.benchmarks.split(',')
+    for name in names:
+        if name not in BENCHMARKS:
+            p.error(f"unknown benchmark '{name}'; must be one of {', '.join(BENCHMARKS)}")
+
+    params = dict(SIZES[args.size])
+    for key in ('n_samples', 'n_hashes', 'density', 'matrix_hashes'):
+        if getattr(args, key) is not None:
+            params[key] = getattr(args, key)
+    params.update(background=args.background, seed=args.seed)
+
+    if args.data_dir:
+        os.makedirs(args.data_dir, exist_ok=True)
+        workdir = contextlib.nullcontext(args.data_dir)
+    else:
+        workdir = tempfile.TemporaryDirectory()
+
+    with workdir as dirname:
+        results = run_benchmarks(params, names, workdir=dirname,
+                                 repeat=args.repeat,
+                                 n_background=args.background, seed=args.seed)
+
+    history = read_history(args.history)
+    baseline = find_baseline(history, params, label=args.baseline)
+    n_regressed = 0
+    if baseline is None:
+        print("no earlier run with these parameters to compare against.")
+    else:
+        print(f"compared to run of {baseline['timestamp']} ({baseline.get('label') or baseline.get('commit') or 'unlabeled'}):")
+        for name, seconds, base, regressed in compare_to_baseline(
+                results, baseline, max_slowdown=args.max_slowdown,
+                min_seconds=args.min_seconds):
+            flag = ' REGRESSION' if regressed else ''
+            print(f"\t{name}: {seconds:.3f}s vs {base:.3f}s ({base / seconds if seconds else 0:.2f}x speedup){flag}")
+            n_regressed += regressed
+
+    if not args.no_record:
+        record = dict(timestamp=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                      label=args.label,
+                      commit=git_commit(),
+                      python=platform.python_version(),
+                      numpy=numpy.__version__,
+                      machine=platform.machine(),
+                      params=params,
+                      results=results)
+        with open(args.history, 'a') as fp:
+            fp.write(json.dumps(record) + '\n')
+        print(f"appended results to '{args.history}'")
+
+    if n_regressed:
+        print(f"{n_regressed} benchmark(s) regressed by more than {args.max_slowdown}x")
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
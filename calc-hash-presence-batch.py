@@ -0,0 +1,142 @@
+#! /usr/bin/env python
+"""
+Calculate hash presence/absence information for many pangenomes at once,
+scanning the sample sketches a single time.
+"""
+import sys
+import os
+import argparse
+
+import sourmash_utils
+from hash_presence_lib import (PangenomeQueries, PresenceBitMatrix,
+                               read_ranktable_csv, scan_sketches,
+                               minhash_to_array, ProgressBar, RunReport,
+                               SketchHashCache)
+
+
+def pangenome_name(filename):
+    "Name a pangenome after its ranktable or source sketch file."
+    name = os.path.basename(filename)
+    for suffix in ('.csv', '.sig.zip', '.zip', '.sig.gz', '.sig'):
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('sketches')
+    p.add_argument('-r', '--ranktables', nargs='+', default=[],
+                   help='ranktable CSVs, one per pangenome')
+    p.add_argument('-s', '--source-sketches', nargs='+', default=[],
+                   help='sketches whose hashes are the query, one per pangenome')
+    p.add_argument('-o', '--output-pattern', default='{name}.dump',
+                   help="output dump filename for each pangenome; '{name}' is the ranktable or sketch filename without its extension (default: '{name}.dump')")
+    p.add_argument('--filter-samples', default=None,
+                   help='only scan sketches whose names are listed in this file, one per line')
+    p.add_argument('-p', '--cores', type=int, default=1,
+                   help='number of processes to use for scanning sketches')
+    sourmash_utils.add_standard_minhash_args(p)
+    SketchHashCache.add_args(p)
+    RunReport.add_args(p)
+    args = p.parse_args()
+
+    if not args.ranktables and not args.source_sketches:
+        p.error('please provide at least one of --ranktables or --source-sketches')
+
+    names = [ pangenome_name(x)
+              for x in args.ranktables + args.source_sketches ]
+    outputs = [ args.output_pattern.format(name=name) for name in names ]
+    if len(set(outputs)) != len(outputs):
+        p.error('pangenome output filenames are not unique; please rename the inputs or change --output-pattern')
+
+    report = RunReport.from_args(args)
+    report.begin('load')
+
+    select_mh = sourmash_utils.create_minhash_from_args(args)
+    print(f"selecting sketches: {select_mh}")
+
+    # Load the samples
+    print(f"loading sketches from file '{args.sketches}'")
+    idx = sourmash_utils.load_index_and_select(args.sketches, select_mh)
+
+    print(f"found {len(idx)} metagenomes")
+
+    template = next(iter(idx.signatures())).minhash.copy_and_clear()
+    if not args.scaled:
+        args.scaled = template.scaled
+
+    # load the query hashes for each pangenome
+    queries = []
+    classify_ds = []
+    for filename in args.ranktables:
+        classify_d = read_ranktable_csv(filename)
+        query_minhash = template.copy_and_clear()
+        query_minhash.add_many(classify_d)
+        query_minhash = query_minhash.downsample(scaled=args.scaled)
+
+        queries.append(minhash_to_array(query_minhash))
+        classify_ds.append(classify_d)
+        print(f"loaded {len(classify_d)} hashvals from '{filename}'; {len(queries[-1])} at scaled={args.scaled}.")
+
+    for filename in args.source_sketches:
+        query_ss = sourmash_utils.load_index_and_select(filename, select_mh)
+        assert len(query_ss) == 1
+        query_ss = list(query_ss.signatures())[0]
+        query_minhash = query_ss.minhash.downsample(scaled=args.scaled)
+
+        queries.append(minhash_to_array(query_minhash))
+        classify_ds.append({})
+        print(f"loaded {len(queries[-1])} hashes from '{filename}' at scaled={args.scaled}.")
+
+    queries = PangenomeQueries(queries)
+    print(f"{len(queries.hashvals)} distinct hashes across {len(queries)} pangenomes.")
+
+    filter_by_name = None
+    if args.filter_samples:
+        filter_by_name = set([ x.strip() for x in open(args.filter_samples) ])
+
+    # calculate sample presence for all pangenomes in one pass
+    report.begin('scan')
+    presence_bits = [ PresenceBitMatrix(hashes, n_samples=len(idx))
+                      for hashes in queries.queries ]
+    scanned_md5s = []
+    n_skipped = 0
+    scan = scan_sketches([args.sketches], select_mh, scaled=args.scaled,
+                         query_hashes=queries.hashvals,
+                         filter_names=filter_by_name, cores=args.cores,
+                         cache=SketchHashCache.from_args(args))
+    progress = ProgressBar(len(idx), desc='scanning', unit='signatures')
+    for metag_name, md5, hits in scan:
+        progress.update()
+        if hits is None:
+            n_skipped += 1
+            continue
+
+        scanned_md5s.append(md5)
+        if len(hits):
+            for bits, positions in zip(presence_bits,
+                                       queries.split_hits(hits)):
+                if len(positions):
+                    bits.add_sample(metag_name, positions)
+    progress.close()
+    report.count(progress.n, 'signatures')
+
+    report.begin('write')
+    for bits, classify_d, output in zip(presence_bits, classify_ds, outputs):
+        presence_info = bits.to_presence_info(
+            ksize=select_mh.ksize,
+            scaled=args.scaled,
+            moltype=select_mh.moltype,
+            classify_d=classify_d,
+            scanned_md5s=scanned_md5s)
+
+        print(f"saving {len(presence_info)} hashes across {len(presence_info.sample_names)} samples to '{output}'")
+        presence_info.save_to_file(output)
+
+    print(f'skipped: {n_skipped}')
+    report.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -7,13 +7,15 @@ import sys
 import argparse
 import sourmash
 import csv
-from collections import defaultdict
 import numpy
 import pickle
 
 import sourmash_utils
 from sourmash_plugin_pangenomics import NAMES
-from hash_presence_lib import HashPresenceInformation, read_ranktable_csv
+from hash_presence_lib import (PresenceBitMatrix, read_ranktable_csv,
+                               scan_sketches, minhash_to_array,
+                               ProgressBar, RunReport,
+                               SketchHashCache)
 
 
 
@@ -23,11 +25,20 @@ def main():
     p.add_argument('sketches', nargs='+')
     p.add_argument('-o', '--output', required=True)
     p.add_argument('-C', '--category-out')
+    p.add_argument('--filter-samples', default=None,
+                   help='only scan sketches whose names are listed in this file, one per line')
+    p.add_argument('-p', '--cores', type=int, default=1,
+                   help='number of processes to use for scanning sketches')
     sourmash_utils.add_standard_minhash_args(p)
+    SketchHashCache.add_args(p)
+    RunReport.add_args(p)
     args = p.parse_args()
 
-    hash_to_sample = defaultdict(set)
+    report = RunReport.from_args(args)
+    report.begin('load')
+
     samples = []
+    scanned_md5s = []
 
     select_mh = sourmash_utils.create_minhash_from_args(args)
     print(f"selecting sketches: {select_mh}")
@@ -40,36 +51,48 @@ def main():
     query_ss = list(query_ss.signatures())[0]
     query_minhash = query_ss.minhash
     query_minhash = query_minhash.downsample(scaled=args.scaled)
-    query_hashes = set(query_minhash.hashes)
+    query_hashes = minhash_to_array(query_minhash)
 
     print(f"loaded {len(query_hashes)} hashes at {args.scaled}.")
 
+    filter_by_name = None
+    if args.filter_samples:
+        filter_by_name = set([ x.strip() for x in open(args.filter_samples) ])
+
     # calculate sample presence
-    n = 0
-    for sketch_filename in args.sketches:
-        idx = sourmash_utils.load_index_and_select(sketch_filename,
-                                                   select_mh)
-        for ss in idx.signatures():
-            n += 1
-            sig_name = ss.name
-            if n and n % 10 == 0:
-                print('...', n)
-
-#        if n > 100:
-#            break
-            sig_mh = ss.minhash.downsample(scaled=args.scaled)
-            if query_minhash.contained_by(sig_mh) > 0:
-                samples.append(sig_name)
-                sig_hashes = set(sig_mh.hashes) & query_hashes
-                for hashval in sig_hashes:
-                    hash_to_sample[hashval].add(sig_name)
-
-    presence_info = HashPresenceInformation(ksize=args.ksize,
-                                            scaled=args.scaled,
-                                            moltype=select_mh.moltype,
-                                            classify_d={},
-                                            hash_to_sample=hash_to_sample)
+    report.begin('scan')
+    presence_bits = PresenceBitMatrix(query_hashes)
+    scan = scan_sketches(args.sketches, select_mh, scaled=args.scaled,
+                         query_hashes=query_hashes,
+                         filter_names=filter_by_name, cores=args.cores,
+                         cache=SketchHashCache.from_args(args))
+    n_skipped = 0
+    progress = ProgressBar(desc='scanning', unit='signatures')
+    for sig_name, md5, hits in scan:
+        progress.update()
+        if hits is None:
+            n_skipped += 1
+            continue
+        scanned_md5s.append(md5)
+        if len(hits):
+            samples.append(sig_name)
+            presence_bits.add_sample(sig_name, hits)
+
+    progress.close()
+    report.count(progress.n, 'signatures')
 
+    report.begin('build')
+    presence_info = presence_bits.to_presence_info(
+        ksize=select_mh.ksize,
+        scaled=args.scaled,
+        moltype=select_mh.moltype,
+        classify_d={},
+        scanned_md5s=scanned_md5s)
+
+    if args.filter_samples:
+        print(f'skipped: {n_skipped}')
+
+    report.begin('write')
     presence_info.save_to_file(args.output)
 
     if args.category_out:
@@ -78,6 +101,8 @@ def main():
             for label in samples:
                 fp.write(f'{label},default\n')
 
+    report.close()
+
 
 if __name__ == '__main__':
    sys.exit(main())
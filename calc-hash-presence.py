@@ -6,13 +6,16 @@ import sys
 import argparse
 import sourmash
 import csv
-from collections import defaultdict
 import numpy
 import pickle
 
 import sourmash_utils
 from sourmash_plugin_pangenomics import NAMES
-from hash_presence_lib import HashPresenceInformation, read_ranktable_csv
+from hash_presence_lib import (HashPresenceInformation, PresenceBitMatrix,
+                               read_ranktable_csv, scan_sketches,
+                               load_sketches,
+                               minhash_to_array, ProgressBar, RunReport,
+                               SketchHashCache)
 
 
 
@@ -22,16 +25,34 @@ def main():
     p.add_argument('sketches')
     p.add_argument('-o', '--output', required=True)
     p.add_argument('--filter-samples', default=None)
+    p.add_argument('-p', '--cores', type=int, default=1,
+                   help='number of processes to use for scanning sketches')
+    p.add_argument('--update', default=None,
+                   help='add presence for sketches not yet scanned to this existing presence dump')
     sourmash_utils.add_standard_minhash_args(p)
+    SketchHashCache.add_args(p)
+    RunReport.add_args(p)
     args = p.parse_args()
 
+    report = RunReport.from_args(args)
+    report.begin('load')
     classify_d = read_ranktable_csv(args.ranktable_csv)
     print(f"loaded {len(classify_d)} hashvals... downsampling soon.")
 
-    hash_to_sample = defaultdict(set)
+    existing = None
+    skip_md5s = None
+    if args.update:
+        existing = HashPresenceInformation.load_from_file(args.update)
+        print(f"updating '{args.update}': {len(existing)} hashes, {len(existing.scanned_md5s)} sketches already scanned.")
+        args.ksize = args.ksize or existing.ksize
+        args.scaled = args.scaled or existing.scaled
+        skip_md5s = existing.scanned_md5s
 
     select_mh = sourmash_utils.create_minhash_from_args(args)
     print(f"selecting sketches: {select_mh}")
+    if existing is not None:
+        existing.check_compatible(ksize=select_mh.ksize, scaled=args.scaled,
+                                  moltype=select_mh.moltype)
 
     # Load the samples
     print(f"loading sketches from file '{args.sketches}'")
@@ -39,15 +60,20 @@ def main():
 
     print(f"found {len(idx)} metagenomes")
 
+    n_to_scan = len(idx)
+    if skip_md5s:
+        n_to_scan = len(load_sketches(args.sketches, select_mh,
+                                      skip_md5s=skip_md5s))
+        print(f"{n_to_scan} of them not yet scanned")
+
     query_minhash = next(iter(idx.signatures())).minhash.copy_and_clear()
-    for hashval in classify_d:
-        query_minhash.add_hash(hashval)
+    query_minhash.add_many(classify_d)
     if args.scaled:
         query_minhash = query_minhash.downsample(scaled=args.scaled)
     else:
         args.scaled = query_minhash.scaled
 
-    hashes = list(sorted(set(query_minhash.hashes)))
+    hashes = minhash_to_array(query_minhash)
     print(f"at downsampled scale={args.scaled}, {len(hashes)} hashes found.")
 
     filter_by_name = None
@@ -55,33 +81,44 @@ def main():
         filter_by_name = set([ x.strip() for x in open(args.filter_samples) ])
 
     # calculate sample presence
+    report.begin('scan')
+    presence_bits = PresenceBitMatrix(hashes, n_samples=n_to_scan)
+    scanned_md5s = []
     n_skipped = 0
-    for n, metag_ss in enumerate(idx.signatures()):
-        metag_name = metag_ss.name
-        if n and n % 10 == 0:
-            print('...', n)
-        if filter_by_name is not None and metag_name not in filter_by_name:
+    scan = scan_sketches([args.sketches], select_mh, scaled=args.scaled,
+                         query_hashes=hashes, filter_names=filter_by_name,
+                         skip_md5s=skip_md5s, cores=args.cores,
+                         cache=SketchHashCache.from_args(args))
+    progress = ProgressBar(n_to_scan, desc='scanning', unit='signatures')
+    for metag_name, md5, hits in scan:
+        progress.update()
+        if hits is None:
             n_skipped += 1
             continue
 
-#        if n > 100:
-#            break
-        metag_mh = metag_ss.minhash.downsample(scaled=args.scaled)
-        if query_minhash.contained_by(metag_mh) > 0:
-            metag_hashes = set(metag_mh.hashes)
-            for hashval in hashes:
-                if hashval in metag_hashes:
-                    hash_to_sample[hashval].add(metag_name)
-
-    presence_info = HashPresenceInformation(ksize=args.ksize,
-                                            scaled=args.scaled,
-                                            moltype=select_mh.moltype,
-                                            classify_d=classify_d,
-                                            hash_to_sample=hash_to_sample)
-
+        scanned_md5s.append(md5)
+        if len(hits):
+            presence_bits.add_sample(metag_name, hits)
+    progress.close()
+    report.count(progress.n, 'signatures')
+
+    report.begin('build')
+    presence_info = presence_bits.to_presence_info(
+        ksize=select_mh.ksize,
+        scaled=args.scaled,
+        moltype=select_mh.moltype,
+        classify_d=classify_d,
+        scanned_md5s=scanned_md5s)
+
+    if existing is not None:
+        print(f"scanned {len(scanned_md5s)} new sketches; merging with '{args.update}'")
+        presence_info = existing.merge(presence_info)
+
+    report.begin('write')
     presence_info.save_to_file(args.output)
 
     print(f'skipped: {n_skipped}')
+    report.close()
 
 
 if __name__ == '__main__':
@@ -10,26 +10,144 @@ import csv
 import sourmash
 from sourmash import sourmash_args
 import numpy
+import scipy.sparse
 import seaborn as sns
 import sklearn.cluster
+import sklearn.metrics
 import matplotlib.pyplot as plt
 from collections import defaultdict
 from matplotlib.lines import Line2D
 
 
-from hash_presence_lib import HashPresenceInformation
+from hash_presence_lib import (HashPresenceInformation, PresenceFilter,
+                               AssociationCache, sparse_distance_graph,
+                               hdbscan_sweep, leiden_clusters, plot_order,
+                               block_starts, block_average, class_replicas,
+                               expand_matrix, RunReport)
+
+
+def parse_int_list(value):
+    """
+    Parse a comma-separated list of integers and inclusive ranges,
+    e.g. '5,10,20:50:10' => [5, 10, 20, 30, 40, 50].
+    """
+    values = []
+    for item in value.split(','):
+        if ':' in item:
+            start, stop, *step = map(int, item.split(':'))
+            step = step[0] if step else 1
+            values.extend(range(start, stop + 1, step))
+        else:
+            values.append(int(item))
+    return values
+
+
+def clusters_from_labels(hashvals, labels):
+    "Group hashvals by cluster label, with clusters renumbered by size."
+    clusters_d = defaultdict(set)
+    unclust = set()
+    for hashval, cluster_num in zip(hashvals, labels):
+        if cluster_num >= 0:
+            clusters_d[cluster_num].add(hashval)
+        else:
+            unclust.add(hashval)
+
+    # reorder by size:
+    new_clusters_d = {}
+    new_cluster_id = 0
+    for n, v in enumerate(sorted(clusters_d.values(), key=lambda x: -len(x))):
+        new_clusters_d[new_cluster_id] = v
+        new_cluster_id += 1
+
+    return new_clusters_d, unclust
+
+
+def write_categories_csv(filename, clusters_d, unclust):
+    with sourmash_args.FileOutputCSV(filename) as csv_fp:
+        w = csv.writer(csv_fp)
+
+        w.writerow(["label", "category", "cluster"])
+        for k, v in clusters_d.items():
+            name = f"cluster {k}"
+            for hashval in v:
+                w.writerow([hashval, name, k])
+        for hashval in unclust:
+            w.writerow([hashval, "unclustered", -1])
+
+
+def summarize_clustering(labels, probabilities, prev_labels=None):
+    "Summarize one clustering, for the parameter sweep table."
+    sizes = numpy.bincount(labels[labels >= 0])
+    sizes = numpy.sort(sizes[sizes > 0])[::-1]
+    n_noise = int((labels < 0).sum())
+    clustered = labels >= 0
+
+    summary = dict(n_clusters=len(sizes),
+                   n_noise=n_noise,
+                   noise_fraction=round(n_noise / max(len(labels), 1), 4),
+                   largest_cluster=int(sizes[0]) if len(sizes) else 0,
+                   median_cluster_size=float(numpy.median(sizes)) if len(sizes) else 0,
+                   smallest_cluster=int(sizes[-1]) if len(sizes) else 0,
+                   mean_probability=round(float(probabilities[clustered].mean()), 4) if clustered.any() else 0,
+                   ari_to_previous='')
+    if prev_labels is not None:
+        ari = sklearn.metrics.adjusted_rand_score(prev_labels, labels)
+        summary['ari_to_previous'] = round(ari, 4)
+    return summary
+
+
+def plot_blocks(filename, blocks, *, col_colors, row_colors=None,
+                figsize=(8, 8), cmap='rocket'):
+    """
+    Draw a block-averaged matrix as an image, with a strip of cluster
+    colors for each block along the top (and optionally the left side).
+    """
+    fig = plt.figure(figsize=figsize)
+    grid = fig.add_gridspec(2, 2, width_ratios=[1, 40],
+                            height_ratios=[1, 40], wspace=0.01, hspace=0.01)
+
+    ax = fig.add_subplot(grid[1, 1])
+    image = ax.imshow(blocks, aspect='auto', interpolation='nearest',
+                      cmap=cmap, vmin=0, vmax=1)
+    ax.set_xticks([])
+    ax.set_yticks([])
+
+    top = fig.add_subplot(grid[0, 1], sharex=ax)
+    top.imshow(numpy.array([col_colors]), aspect='auto',
+               interpolation='nearest')
+    top.axis('off')
+    if row_colors is not None:
+        left = fig.add_subplot(grid[1, 0], sharey=ax)
+        left.imshow(numpy.array([row_colors]).transpose(1, 0, 2),
+                    aspect='auto', interpolation='nearest')
+        left.axis('off')
+
+    fig.colorbar(image, ax=ax, fraction=0.03)
+    fig.savefig(filename)
+
 
 def main():
     p = argparse.ArgumentParser()
     p.add_argument('presence_pickle')
-    p.add_argument('--min-cluster-size', type=int, default=15,
-                   help='hdbscan min_cluster_size parameter')
+    p.add_argument('--min-cluster-size', type=parse_int_list, default=[15],
+                   help="hdbscan min_cluster_size parameter; a list or range of values, e.g. '5,10,20:50:10', runs a parameter sweep")
+    p.add_argument('--min-samples', type=parse_int_list, default=None,
+                   help="hdbscan min_samples parameter (default: min_cluster_size); a list or range of values runs a parameter sweep")
+    p.add_argument('--sweep-summary', default=None,
+                   help="for a parameter sweep, write the summary table to this CSV (default: <cluster-prefix>.sweep.csv)")
     p.add_argument('--output-tsne-plot',
                    help='save (optional) tSNE plot to this file')
     p.add_argument('--output-assoc-plot',
                    help='save (optional) square hash association plot to this file')
     p.add_argument('--output-presence-plot',
                    help='save (optional) rectangular sample presence plot to this file')
+    p.add_argument('--plot-mode', choices=['cluster', 'labels'],
+                   default='cluster',
+                   help="'cluster' reclusters the association and presence plots hierarchically; 'labels' orders them by cluster label and averages them down to --plot-resolution, and subsamples the tSNE plot, so that plotting time stays bounded for large inputs (default: cluster)")
+    p.add_argument('--plot-resolution', type=int, default=1000,
+                   help="with --plot-mode labels, the maximum number of blocks along each axis of the association and presence plots (default: 1000)")
+    p.add_argument('--tsne-max-points', type=int, default=None,
+                   help="embed at most this many randomly chosen hashes in the tSNE plot (default: 5000 with --plot-mode labels, otherwise all)")
     p.add_argument(
         "--cluster-prefix",
         default=None,
@@ -39,49 +157,144 @@ def main():
     p.add_argument('--min-presence', type=int, default=5)
     p.add_argument('--save-categories-csv',
                    help="write categories CSV for clusters")
+    p.add_argument('--threshold', type=float, default=None,
+                   help="cluster a sparse graph of hash pairs with Jaccard >= this, instead of the dense matrix")
+    p.add_argument('--top-k', type=int, default=None,
+                   help="cluster a sparse graph of the k most similar hashes for each hash, instead of the dense matrix; at least --min-cluster-size neighbors are always kept")
+    p.add_argument('--backend', choices=['dense', 'knn', 'leiden'],
+                   default='dense',
+                   help="'dense' clusters the full association matrix (or the exact sparse graph from --threshold/--top-k) with HDBSCAN; 'knn' builds an approximate nearest-neighbor graph with MinHash LSH and clusters it with HDBSCAN; 'leiden' clusters the same graph with Leiden (default: dense)")
+    p.add_argument('--leiden-resolution', type=float, default=1.0,
+                   help="resolution parameter for --backend leiden (default: 1.0)")
+    p.add_argument('-p', '--cores', type=int, default=1,
+                   help="number of processes to use for the dense matrix computation and parameter sweeps (default: 1)")
+    p.add_argument('--collapse', action='store_true',
+                   help="compute the association matrix and cluster once per class of hashes with identical sample sets")
+    p.add_argument('--view-dir', default=None,
+                   help="save the filtered presence information in this directory, and reuse it in later runs with the same dump and filters")
+    p.add_argument('--cache-dir', default=None,
+                   help="cache association matrices in this directory, and reuse them in later runs on the same presence data")
+    p.add_argument('--cache-size', type=float, default=10240,
+                   help="with --cache-dir, evict least recently used matrices to keep the cache under this many MB (default: 10240)")
+    RunReport.add_args(p)
     args = p.parse_args()
 
-    presence_info = HashPresenceInformation.load_from_file(args.presence_pickle)
-    print(f"loaded {len(presence_info.hash_to_sample)} hash to sample entries.")
-    if args.scaled:
-        presence_info = presence_info.downsample(args.scaled)
-        print(f"downsampled to {presence_info.scaled}; {len(presence_info.hash_to_sample)} hashes left.")
+    is_sparse = args.threshold is not None or args.top_k is not None or \
+        args.backend != 'dense'
+    settings = [ (min_cluster_size, min_samples)
+                 for min_cluster_size in args.min_cluster_size
+                 for min_samples in (args.min_samples or [None]) ]
+    is_sweep = len(settings) > 1
+    if args.backend != 'dense' and args.threshold is not None:
+        p.error("--threshold can only be used with --backend dense")
+    if args.backend == 'leiden' and is_sweep:
+        p.error("parameter sweeps are only supported with HDBSCAN")
+    if is_sweep and (args.output_tsne_plot or args.output_assoc_plot or
+                     args.output_presence_plot or args.save_categories_csv):
+        p.error("--output-tsne-plot, --output-assoc-plot, --output-presence-plot and --save-categories-csv need a single min-cluster-size/min-samples setting, not a parameter sweep")
+    prefix = args.cluster_prefix or os.path.basename(args.presence_pickle)
 
+    report = RunReport.from_args(args)
+    report.begin('load')
+    presence_filter = PresenceFilter()
+    if args.scaled:
+        presence_filter = presence_filter.downsample(args.scaled)
     if args.min_presence > 1:
-        presence_info = presence_info.filter_by_min_samples(args.min_presence)
-        print(f"filtered to min_presence={args.min_presence}; {len(presence_info.hash_to_sample)} hashes left.")
-
-    # build similarity matrix
-    hashvals, cmp = presence_info.build_association_matrix()
-
-    # turn into distance matrix
-    dist = 1 - cmp
+        presence_filter = presence_filter.filter_by_min_samples(args.min_presence)
+
+    presence_info = HashPresenceInformation.load_from_file(
+        args.presence_pickle, presence_filter, view_dir=args.view_dir)
+    print(f"loaded {len(presence_info)} hashes after filtering ({presence_filter}).")
+    report.count(len(presence_info), 'hashes')
+
+    if args.collapse:
+        full_info = presence_info
+        presence_info, inverse, counts = full_info.collapse_identical()
+        print(f"collapsed {len(full_info)} hashes into {len(presence_info)} classes of identical presence sets.")
+
+    cache = None
+    if args.cache_dir:
+        cache = AssociationCache(args.cache_dir,
+                                 max_size=int(args.cache_size * 1024**2))
+
+    # build similarity matrix, and turn into distance matrix
+    report.begin('matrix')
+    if is_sparse:
+        # HDBSCAN needs at least min_samples neighbors for each hash.
+        # the approximate kNN graph keeps 15 neighbors unless told otherwise.
+        default_k = 15 if args.backend != 'dense' else 0
+        top_k = max([args.top_k or default_k] +
+                    [ min_samples or min_cluster_size
+                      for min_cluster_size, min_samples in settings ])
+        if args.backend != 'dense':
+            if cache:
+                hashvals, cmp = cache.knn_association_matrix(presence_info,
+                                                             k=top_k)
+            else:
+                hashvals, cmp = presence_info.build_knn_association_matrix(
+                    k=top_k)
+        elif cache:
+            hashvals, cmp = cache.sparse_association_matrix(
+                presence_info, threshold=args.threshold, top_k=top_k)
+        else:
+            hashvals, cmp = presence_info.build_sparse_association_matrix(
+                threshold=args.threshold, top_k=top_k)
+        dist = sparse_distance_graph(cmp)
+    else:
+        if cache:
+            hashvals, cmp = cache.association_matrix(presence_info,
+                                                     cores=args.cores)
+        else:
+            hashvals, cmp = presence_info.build_association_matrix(
+                cores=args.cores)
+        report.count(len(hashvals) * (len(hashvals) - 1) // 2, 'pairs')
+        dist = 1 - cmp
+
+    cluster_cmp = cmp
+    hash_rows = None
+    if args.collapse:
+        # HDBSCAN has no sample weights, so cluster each class as up to
+        # max(min_cluster_size, min_samples) identical points: enough for
+        # a class to be dense, and to form a cluster, on its own.
+        max_copies = max(max(min_cluster_size, min_samples or min_cluster_size)
+                         for min_cluster_size, min_samples in settings)
+        rows, first_copy = class_replicas(counts, max_copies)
+        hash_rows = first_copy[inverse]
+        if is_sparse:
+            cluster_cmp = expand_matrix(cmp, rows)
+            dist = sparse_distance_graph(cluster_cmp)
+        else:
+            # weight each class's column by sqrt(class size), so that the
+            # euclidean distances between rows match the full matrix.
+            dist = dist[rows] * numpy.sqrt(counts)
+        print(f"clustering {len(rows)} points for {len(hash_rows)} hashes.")
+        hashvals = full_info.hashvals.tolist()
+
+    if is_sweep:
+        report.begin('sweep')
+        run_sweep(args, settings, hashvals, dist, prefix, hash_rows=hash_rows)
+        report.count(len(settings), 'settings')
+        report.close()
+        return
 
     # cluster!
-    print(f"clustering using hdbscan with min_cluster_size={args.min_cluster_size}")
-    min_cluster_size=args.min_cluster_size
-
-    hdbscan = sklearn.cluster.HDBSCAN(min_cluster_size=min_cluster_size)
-    labels = hdbscan.fit_predict(dist)
-
+    report.begin('cluster')
+    if args.backend == 'leiden':
+        (min_cluster_size, _), = settings
+        labels = leiden_clusters(cluster_cmp,
+                                 min_cluster_size=min_cluster_size,
+                                 resolution=args.leiden_resolution)
+        print(f"clustered using leiden with resolution={args.leiden_resolution}, min_cluster_size={min_cluster_size}")
+    else:
+        (setting, labels, _), = hdbscan_sweep(dist, settings)
+        min_cluster_size, min_samples = setting
+        print(f"clustered using hdbscan with min_cluster_size={min_cluster_size}, min_samples={min_samples or min_cluster_size}")
+    if hash_rows is not None:
+        labels = labels[hash_rows]
     print(f'got {numpy.unique(labels).max()} clusters')
 
     ## pull out the clusters ;)
-    clusters_d = defaultdict(set)
-    unclust = set()
-    for hashval, cluster_num in zip(hashvals, labels):
-        if cluster_num >= 0:
-            clusters_d[cluster_num].add(hashval)
-        else:
-            unclust.add(hashval)
-
-    # reorder by size:
-    new_clusters_d = {}
-    new_cluster_id = 0
-    for n, v in enumerate(sorted(clusters_d.values(), key=lambda x: -len(x))):
-        new_clusters_d[new_cluster_id] = v
-        new_cluster_id += 1
-    clusters_d = new_clusters_d
+    clusters_d, unclust = clusters_from_labels(hashvals, labels)
 
     print(f"5 largest clusters (of {len(clusters_d)}:")
     for n, (k, v) in enumerate(sorted(clusters_d.items())):
@@ -90,7 +303,7 @@ def main():
             break
 
     # output clusters
-    prefix = args.cluster_prefix or os.path.basename(args.presence_pickle)
+    report.begin('write')
     print(f"outputting clusters with prefix '{prefix}'")
 
     mh_template = presence_info._make_minhash_obj()
@@ -108,14 +321,50 @@ def main():
 
         cluster_n += 1
     
+    # plots are per hash: expand the collapsed matrix if needed.
+    if args.collapse:
+        presence_info = full_info
+        if args.output_tsne_plot or args.output_assoc_plot:
+            cmp = expand_matrix(cmp, inverse)
+            dist = sparse_distance_graph(cmp) if is_sparse else 1 - cmp
+
     # plot tSNE?
     if args.output_tsne_plot:
+        report.begin('plot_tsne')
         print(f"running tSNE & saving to {args.output_tsne_plot}")
-        tsne = sklearn.manifold.TSNE(n_components=2, random_state=42, perplexity=50) # play with: perplexity
-        tsne_coords = tsne.fit_transform(dist)
+        max_points = args.tsne_max_points
+        if max_points is None and args.plot_mode == 'labels':
+            max_points = 5000
+        tsne_labels = labels
+        tsne_dist = dist
+        tsne_sparse = is_sparse
+        if max_points is not None and len(labels) > max_points:
+            # embed a random subset, with exact distances between its hashes.
+            sub_info = presence_info.subsample(max_points)
+            keep = numpy.searchsorted(presence_info.hashvals, sub_info.hashvals)
+            print(f"subsampling {len(keep)} of {len(labels)} hashes for tSNE")
+            tsne_labels = labels[keep]
+            if is_sparse:
+                _, sub_cmp = sub_info.build_association_matrix(dtype=numpy.float32)
+                tsne_dist = 1 - sub_cmp
+                tsne_sparse = False
+            else:
+                tsne_dist = dist[numpy.ix_(keep, keep)]
+
+        if tsne_sparse:
+            # tSNE needs 3 * perplexity neighbors for each hash in the graph.
+            min_neighbors = numpy.diff(tsne_dist.indptr).min() - 1
+            perplexity = min(50, max(min_neighbors - 1, 1) / 3)
+            print(f"using perplexity={perplexity:.1f} for sparse graph")
+            tsne = sklearn.manifold.TSNE(n_components=2, random_state=42,
+                                         perplexity=perplexity,
+                                         metric='precomputed', init='random')
+        else:
+            tsne = sklearn.manifold.TSNE(n_components=2, random_state=42, perplexity=min(50, len(tsne_labels) - 1)) # play with: perplexity
+        tsne_coords = tsne.fit_transform(tsne_dist)
 
         palette = sns.color_palette('deep', numpy.unique(labels).max() + 1)
-        cluster_colors = [palette[x] if x >= 0 else (0.0, 0.0, 0.0) for x in labels]
+        cluster_colors = [palette[x] if x >= 0 else (0.0, 0.0, 0.0) for x in tsne_labels]
 
         plt.scatter(tsne_coords[:, 0], tsne_coords[:, 1], color=cluster_colors)
         plt.xlabel("Dimension 1")
@@ -126,57 +375,140 @@ def main():
     ## square association plot, our standard "cmp"
 
     if args.output_assoc_plot:
+        report.begin('plot_assoc')
         print(f"running square association plot & saving to {args.output_assoc_plot}")
 
         palette = sns.color_palette('deep', numpy.unique(labels).max() + 1)
         # make uncluster => white
         cluster_colors = [palette[x] if x >= 0 else (1.0, 1.0, 1.0) for x in labels]
 
-        fig = sns.clustermap(cmp, xticklabels=[], yticklabels=[], figsize=(8, 8), row_colors=cluster_colors) # , col_colors=category_colors)
+        if args.plot_mode == 'labels':
+            order = plot_order(labels)
+            blocks = block_average(cmp, order, order,
+                                   shape=(args.plot_resolution,) * 2)
+            starts = block_starts(len(order), len(blocks))
+            block_colors = [cluster_colors[i] for i in order[starts]]
+            print(f"averaged {len(order)} x {len(order)} matrix down to {blocks.shape[0]} x {blocks.shape[1]} blocks")
+            plot_blocks(args.output_assoc_plot, blocks,
+                        col_colors=block_colors, row_colors=block_colors)
+        elif is_sparse:
+            # the sparse matrix is mostly zeros, which hierarchical
+            # clustering handles poorly; order by cluster label instead.
+            order = numpy.argsort(labels, kind='stable')
+            fig = sns.clustermap(cmp[order][:, order].toarray(),
+                                 xticklabels=[], yticklabels=[],
+                                 figsize=(8, 8),
+                                 row_colors=[cluster_colors[i] for i in order],
+                                 row_cluster=False, col_cluster=False)
+        else:
+            fig = sns.clustermap(cmp, xticklabels=[], yticklabels=[], figsize=(8, 8), row_colors=cluster_colors) # , col_colors=category_colors)
 
-        # create a custom legend of just the pangenome rank colors on the columns
-        if 0:
-            legend_elements = []
-            for k, v in category_map.items():
-                legend_elements.append(
-                    Line2D([0], [0], color=v, label=k, marker="o", lw=0)
-                )
-                fig.ax_col_dendrogram.legend(handles=legend_elements)
+            # create a custom legend of just the pangenome rank colors on the columns
+            if 0:
+                legend_elements = []
+                for k, v in category_map.items():
+                    legend_elements.append(
+                        Line2D([0], [0], color=v, label=k, marker="o", lw=0)
+                    )
+                    fig.ax_col_dendrogram.legend(handles=legend_elements)
 
-        plt.savefig(args.output_assoc_plot)
+        if args.plot_mode != 'labels':
+            # plot_blocks saves the labels-mode plot itself.
+            plt.savefig(args.output_assoc_plot)
 
     ## rectangular presence plot
 
     if args.output_presence_plot:
+        report.begin('plot_presence')
         print(f"running rectangular presence plot & saving to {args.output_presence_plot}")
 
-        # make presence_mat!
-        _, _, presence_mat = presence_info.build_presence_matrix()
-
         palette = sns.color_palette('deep', numpy.unique(labels).max() + 1)
         # make uncluster => white
         cluster_colors = [palette[x] if x >= 0 else (1.0, 1.0, 1.0) for x in labels]
 
-        fig = sns.clustermap(presence_mat,
-                             figsize=(11, 8),
-                             xticklabels=[], yticklabels=[],
-                             col_colors=cluster_colors,
-                             cbar_pos=None)
-        plt.savefig(args.output_presence_plot)
+        if args.plot_mode == 'labels':
+            _, _, presence_mat = presence_info.build_presence_matrix(format='csr')
+
+            # order hashes by cluster, and samples by the cluster they
+            # share the most hashes with.
+            order = plot_order(labels)
+            clustered = numpy.flatnonzero(labels >= 0)
+            sample_order = numpy.arange(presence_mat.shape[0])
+            if len(clustered):
+                membership = scipy.sparse.csr_matrix(
+                    (numpy.ones(len(clustered)),
+                     (numpy.arange(len(clustered)), labels[clustered])),
+                    shape=(len(clustered), labels.max() + 1))
+                by_cluster = (presence_mat[:, clustered] @ membership).toarray()
+                sample_order = numpy.lexsort((-by_cluster.sum(axis=1),
+                                              by_cluster.argmax(axis=1)))
+
+            blocks = block_average(presence_mat, sample_order, order,
+                                   shape=(args.plot_resolution,) * 2)
+            starts = block_starts(len(order), blocks.shape[1])
+            print(f"averaged {presence_mat.shape[0]} x {presence_mat.shape[1]} matrix down to {blocks.shape[0]} x {blocks.shape[1]} blocks")
+            plot_blocks(args.output_presence_plot, blocks,
+                        col_colors=[cluster_colors[i] for i in order[starts]],
+                        figsize=(11, 8))
+        else:
+            # make presence_mat! one byte per cell is plenty for 0/1 presence.
+            _, _, presence_mat = presence_info.build_presence_matrix(format='uint8')
+
+            fig = sns.clustermap(presence_mat,
+                                 figsize=(11, 8),
+                                 xticklabels=[], yticklabels=[],
+                                 col_colors=cluster_colors,
+                                 cbar_pos=None)
+            plt.savefig(args.output_presence_plot)
 
     # save categories file for clustermap1/plot3 plotting?
     if args.save_categories_csv:
+        report.begin('write_categories')
         print(f"writing cluster categories CSV to '{args.save_categories_csv}'")
-        with sourmash_args.FileOutputCSV(args.save_categories_csv) as csv_fp:
-            w = csv.writer(csv_fp)
-
-            w.writerow(["label", "category", "cluster"])
-            for k, v in clusters_d.items():
-                name = f"cluster {k}"
-                for hashval in v:
-                    w.writerow([hashval, name, k])
-            for hashval in unclust:
-                w.writerow([hashval, "unclustered", -1])
+        write_categories_csv(args.save_categories_csv, clusters_d, unclust)
+
+    report.close()
+
+
+def run_sweep(args, settings, hashvals, dist, prefix, *, hash_rows=None):
+    """
+    Cluster with each (min_cluster_size, min_samples) setting, writing a
+    categories CSV per setting and a summary table. If given, 'hash_rows'
+    maps each hash to its row of 'dist'.
+    """
+    print(f"running hdbscan parameter sweep over {len(settings)} settings, using {args.cores} processes")
+
+    summary_csv = args.sweep_summary or f"{prefix}.sweep.csv"
+    fieldnames = ['min_cluster_size', 'min_samples', 'n_clusters', 'n_noise',
+                  'noise_fraction', 'largest_cluster', 'median_cluster_size',
+                  'smallest_cluster', 'mean_probability', 'ari_to_previous',
+                  'categories_csv']
+
+    with sourmash_args.FileOutputCSV(summary_csv) as csv_fp:
+        w = csv.DictWriter(csv_fp, fieldnames=fieldnames)
+        w.writeheader()
+
+        prev_labels = None
+        for setting, labels, probabilities in hdbscan_sweep(dist, settings,
+                                                            cores=args.cores):
+            min_cluster_size, min_samples = setting
+            min_samples = min_samples or min_cluster_size
+            if hash_rows is not None:
+                labels = labels[hash_rows]
+                probabilities = probabilities[hash_rows]
+
+            categories_csv = f"{prefix}.mcs{min_cluster_size}.ms{min_samples}.categories.csv"
+            clusters_d, unclust = clusters_from_labels(hashvals, labels)
+            write_categories_csv(categories_csv, clusters_d, unclust)
+
+            summary = summarize_clustering(labels, probabilities, prev_labels)
+            print(f"min_cluster_size={min_cluster_size} min_samples={min_samples}: {summary['n_clusters']} clusters, {summary['noise_fraction']:.1%} unclustered")
+            w.writerow(dict(min_cluster_size=min_cluster_size,
+                            min_samples=min_samples,
+                            categories_csv=categories_csv, **summary))
+            prev_labels = labels
+
+    print(f"wrote sweep summary to '{summary_csv}'")
 
 
 if __name__ == '__main__':
@@ -3,14 +3,22 @@
 using hash presence info, produce a square similarity matrix of hashval x hashval.
 """
 import sys
+import time
 import argparse
 import sourmash
 from sourmash import sourmash_args
 import csv
 import numpy
+import scipy.sparse
 
 from sourmash_plugin_pangenomics import NAMES
-from hash_presence_lib import HashPresenceInformation
+from hash_presence_lib import (HashPresenceInformation, PresenceFilter,
+                               ASSOCIATION_DTYPES, DEFAULT_BLOCK_SIZE,
+                               open_export_file, write_matrix_csv,
+                               write_edge_list_csv,
+                               association_recall, open_association_memmap,
+                               block_size_for_memory,
+                               RunReport)
 
 
 def main():
@@ -20,52 +28,154 @@ def main():
     p.add_argument('--scaled', type=int, default=None)
     p.add_argument('-m', '--min-presence', type=int, default=5)
     p.add_argument('--pangenome-types', type=str, default=None)
-    p.add_argument('--compare-csv', help="write compare CSV", default=None)
+    p.add_argument('--compare-csv', default=None,
+                   help="write compare CSV; compressed if it ends in .gz or .zst")
     p.add_argument('-C', '--categories-csv', help="write categories CSV",
                    default=None)
+    p.add_argument('--threshold', type=float, default=None,
+                   help="write a sparse matrix, keeping only pairs with Jaccard >= this")
+    p.add_argument('--top-k', type=int, default=None,
+                   help="write a sparse matrix, keeping only the k most similar hashes for each hash")
+    p.add_argument('--approximate', action='store_true',
+                   help="with --threshold, find pairs of hashes with MinHash LSH instead of comparing all pairs; similarities are exact, but some pairs may be missed (see --recall)")
+    p.add_argument('--recall', type=float, default=0.95,
+                   help="with --approximate, the minimum probability of finding each pair at the threshold similarity (default: 0.95)")
+    p.add_argument('--max-lsh-hashes', type=int, default=256,
+                   help="with --approximate, the maximum MinHash signature size per hash (default: 256)")
+    p.add_argument('--check-exact', action='store_true',
+                   help="with --approximate, also compute the exact matrix and report the recall and run times")
+    p.add_argument('--edge-list', action='store_true',
+                   help="with --threshold/--top-k, write a CSV edge list instead of a scipy .npz matrix")
+    p.add_argument('--dtype', choices=ASSOCIATION_DTYPES, default='float64',
+                   help="dense matrix type; uint16 stores Jaccard * 65535 (default: float64)")
+    p.add_argument('--block-size', type=int, default=None,
+                   help=f"number of hashes per tile of the matrix computation (default: {DEFAULT_BLOCK_SIZE}, or fit to --memory-budget)")
+    p.add_argument('--memmap', action='store_true',
+                   help="write the dense matrix directly into the output file, tile by tile, instead of building it in memory; resumes an interrupted run")
+    p.add_argument('--memory-budget', type=float, default=None,
+                   help="with --memmap, pick a tile size to keep memory use under this many MB")
+    p.add_argument('-p', '--cores', type=int, default=1,
+                   help="number of processes to use for the dense matrix computation (default: 1)")
+    p.add_argument('--collapse', action='store_true',
+                   help="compute the dense matrix once per class of hashes with identical sample sets, and expand it to all hashes")
+    p.add_argument('--view-dir', default=None,
+                   help="save the filtered presence information in this directory, and reuse it in later runs with the same dump and filters")
+    RunReport.add_args(p)
     args = p.parse_args()
 
-    presence_info = HashPresenceInformation.load_from_file(args.presence_pickle)
-    print(f"loaded {len(presence_info.hash_to_sample)} hash to sample entries.")
+    is_sparse = args.threshold is not None or args.top_k is not None
+    if is_sparse and args.compare_csv:
+        p.error("--compare-csv requires a dense matrix; cannot use with --threshold/--top-k")
+    if args.edge_list and not is_sparse:
+        p.error("--edge-list requires --threshold and/or --top-k")
+    if args.memmap and is_sparse:
+        p.error("--memmap cannot be used with --threshold/--top-k")
+    if args.memory_budget and not args.memmap:
+        p.error("--memory-budget requires --memmap")
+    if args.approximate and (args.threshold is None or args.top_k is not None):
+        p.error("--approximate requires --threshold, and cannot be used with --top-k")
+    if args.check_exact and not args.approximate:
+        p.error("--check-exact requires --approximate")
+    if args.collapse and is_sparse:
+        p.error("--collapse cannot be used with --threshold/--top-k")
+    block_size = args.block_size or DEFAULT_BLOCK_SIZE
+
+    report = RunReport.from_args(args)
+    report.begin('load')
+    presence_filter = PresenceFilter()
     if args.scaled:
-        presence_info = presence_info.downsample(args.scaled)
-        print(f"downsampled to {presence_info.scaled}; {len(presence_info.hash_to_sample)} hashes left.")
-
+        presence_filter = presence_filter.downsample(args.scaled)
     if args.min_presence > 1:
-        presence_info = presence_info.filter_by_min_samples(args.min_presence)
-        print(f"filtered to min_presence={args.min_presence}; {len(presence_info.hash_to_sample)} hashes left.")
-
+        presence_filter = presence_filter.filter_by_min_samples(args.min_presence)
     # filter for pangenome_types
     if args.pangenome_types:
         typelist = list(map(int, list(args.pangenome_types)))
-        presence_info = presence_info.filter_by_pangenome_type(typelist)
+        presence_filter = presence_filter.filter_by_pangenome_type(typelist)
 
-        print(f"After pangenome-hash-type filtering to {typelist}, {len(presence_info.hash_to_sample)} left.")
+    presence_info = HashPresenceInformation.load_from_file(
+        args.presence_pickle, presence_filter, view_dir=args.view_dir)
+    print(f"loaded {len(presence_info)} hashes after filtering ({presence_filter}).")
 
     classify_d = presence_info.classify_d
-    hash_to_sample = presence_info.hash_to_sample
-
-    hashes, pa = presence_info.build_association_matrix()
-
-    pa = numpy.zeros((len(hashes), len(hashes)), dtype=float)
-
-    for i in range(len(hashes)):
-        hash_i = hashes[i]
-        presence_i = hash_to_sample[hash_i]
-
-        for j in range(i):
-            hash_j = hashes[j]
-            presence_j = hash_to_sample[hash_j]
-            jaccard = len(presence_i.intersection(presence_j)) / \
-                len(presence_i.union(presence_j))
-            pa[i][j] = jaccard
-            pa[j][i] = jaccard
-
-        pa[i][i] = 1
-
-    print(f"writing similarity matrix to '{args.output}'")
-    with open(args.output, 'wb') as fp:
-        numpy.save(fp, pa)
+    report.count(len(presence_info), 'hashes')
+
+    # every pair of hashes is compared, except with --approximate.
+    report.begin('matrix')
+    n_pairs = len(presence_info) * (len(presence_info) - 1) // 2
+    if args.approximate:
+        start = time.monotonic()
+        hashes, pa = presence_info.build_approximate_association_matrix(
+            threshold=args.threshold, recall=args.recall,
+            max_hashes=args.max_lsh_hashes)
+        approx_time = time.monotonic() - start
+
+        if args.check_exact:
+            start = time.monotonic()
+            _, exact = presence_info.build_sparse_association_matrix(
+                threshold=args.threshold, block_size=block_size)
+            exact_time = time.monotonic() - start
+
+            print(f"approximate: {approx_time:.1f}s; exact: {exact_time:.1f}s")
+            bins = numpy.round(numpy.arange(args.threshold, 1, 0.1), 2)
+            recalls = association_recall(pa, exact, bins=bins)
+            for n, (low, high, n_exact, n_found) in enumerate(recalls):
+                recall = n_found / n_exact if n_exact else 1
+                # the last bin includes its upper edge, 1.0.
+                close = ']' if n == len(recalls) - 1 else ')'
+                print(f"similarity [{low:.2f}, {high:.2f}{close}: found {n_found} of {n_exact} pairs (recall {recall:.3f})")
+
+    if is_sparse:
+        if not args.approximate:
+            hashes, pa = presence_info.build_sparse_association_matrix(
+                threshold=args.threshold, top_k=args.top_k,
+                block_size=block_size)
+            report.count(n_pairs, 'pairs')
+
+        report.begin('write')
+        if args.edge_list:
+            print(f"writing similarity edge list to '{args.output}'")
+            with open_export_file(args.output) as fp:
+                write_edge_list_csv(fp, hashes, pa)
+        else:
+            print(f"writing sparse similarity matrix to '{args.output}'")
+            with open(args.output, 'wb') as fp:
+                scipy.sparse.save_npz(fp, pa)
+    elif args.memmap and args.collapse:
+        # the collapsed matrix is small; expand it straight into the file.
+        out = open_association_memmap(args.output, len(presence_info),
+                                      dtype=args.dtype)
+        hashes, pa = presence_info.build_association_matrix(
+            block_size=block_size, dtype=args.dtype, out=out,
+            cores=args.cores, collapse=True)
+        out.flush()
+        report.count(n_pairs, 'pairs')
+        report.begin('write')
+    elif args.memmap:
+        memmap_block_size = block_size
+        if args.memory_budget and not args.block_size:
+            try:
+                memmap_block_size = block_size_for_memory(
+                    len(presence_info), len(presence_info.sample_names),
+                    int(args.memory_budget * 1024**2),
+                    itemsize=numpy.dtype(args.dtype).itemsize)
+            except ValueError as exc:
+                p.error(f"--memory-budget: {exc}")
+        hashes = presence_info.write_association_matrix(
+            args.output, dtype=args.dtype, block_size=memmap_block_size,
+            cores=args.cores)
+        pa = numpy.load(args.output, mmap_mode='r')
+        report.count(n_pairs, 'pairs')
+        report.begin('write')
+    else:
+        hashes, pa = presence_info.build_association_matrix(
+            block_size=block_size, dtype=args.dtype, cores=args.cores,
+            collapse=args.collapse)
+        report.count(n_pairs, 'pairs')
+
+        report.begin('write')
+        print(f"writing similarity matrix to '{args.output}'")
+        with open(args.output, 'wb') as fp:
+            numpy.save(fp, pa)
     # for 'sourmash plot'
 
     #with open(args.output + '.labels.txt', 'wt') as fp:
@@ -82,16 +192,10 @@ def main():
             w.writerow([n, x, NAMES[classify_d[x]]])
 
     if args.compare_csv:
-        with sourmash_args.FileOutputCSV(args.compare_csv) as csv_fp:
-            w = csv.writer(csv_fp)
+        print(f"writing compare CSV to '{args.compare_csv}'")
+        with open_export_file(args.compare_csv) as fp:
             # hashes as column headers
-            w.writerow([ str(h) for h in hashes ])
-
-            for i in range(len(hashes)):
-                y = []
-                for j in range(len(hashes)):
-                    y.append(str(pa[i][j]))
-                w.writerow(y)
+            write_matrix_csv(fp, pa, header=hashes)
 
     if args.categories_csv:
         print(f"writing categories CSV to '{args.categories_csv}'")
@@ -102,6 +206,8 @@ def main():
             for hashval in hashes:
                 w.writerow([hashval, NAMES[classify_d[hashval]]])
 
+    report.close()
+
 
 if __name__ == '__main__':
    sys.exit(main())
@@ -7,69 +7,74 @@ import argparse
 import sourmash
 from sourmash import sourmash_args
 import csv
+import numpy
+import scipy.sparse
 
 from sourmash_plugin_pangenomics import NAMES
-from hash_presence_lib import HashPresenceInformation
+from hash_presence_lib import (HashPresenceInformation, PresenceFilter,
+                               open_export_file, write_presence_csv,
+                               write_presence_parquet, RunReport)
 
 
 def main():
     p = argparse.ArgumentParser()
     p.add_argument('presence_pickle')
-    p.add_argument('-o', '--output', required=True, help="output CSV")
+    p.add_argument('-o', '--output', required=True,
+                   help="output CSV; compressed if it ends in .gz or .zst")
     p.add_argument('--scaled', type=int, default=None)
     p.add_argument('-m', '--min-presence', type=int, default=5)
     p.add_argument('--pangenome-types', type=str, default=None)
     p.add_argument('-C', '--categories-csv', default=None)
+    p.add_argument('--parquet', action='store_true',
+                   help="write the presence table as Parquet instead of CSV (requires pyarrow)")
+    p.add_argument('--output-matrix', default=None,
+                   help="also save the sample x hash presence matrix as a sparse scipy '.npz' file, with sample names and hashvals in '<name>.labels.npz'")
+    p.add_argument('--view-dir', default=None,
+                   help="save the filtered presence information in this directory, and reuse it in later runs with the same dump and filters")
+    RunReport.add_args(p)
     args = p.parse_args()
 
-    presence_info = HashPresenceInformation.load_from_file(args.presence_pickle)
-    print(f"loaded {len(presence_info.hash_to_sample)} hash to sample entries.")
+    report = RunReport.from_args(args)
+    report.begin('load')
+    presence_filter = PresenceFilter()
     if args.scaled:
-        presence_info = presence_info.downsample(args.scaled)
-        print(f"downsampled to scaled={presence_info.scaled}; {len(presence_info.hash_to_sample)} hashes left.")
-
+        presence_filter = presence_filter.downsample(args.scaled)
     if args.min_presence > 1:
-        presence_info = presence_info.filter_by_min_samples(args.min_presence)
-        print(f"filtered to min_presence={args.min_presence}; {len(presence_info.hash_to_sample)} hashes left.")
-
+        presence_filter = presence_filter.filter_by_min_samples(args.min_presence)
     # filter for pangenome_types
     if args.pangenome_types:
         typelist = list(map(int, list(args.pangenome_types)))
-        presence_info = presence_info.filter_by_pangenome_type(typelist)
+        presence_filter = presence_filter.filter_by_pangenome_type(typelist)
 
-        print(f"After pangenome-hash-type filtering to {typelist}, {len(presence_info.hash_to_sample)} left.")
+    presence_info = HashPresenceInformation.load_from_file(
+        args.presence_pickle, presence_filter, view_dir=args.view_dir)
+    print(f"loaded {len(presence_info)} hashes after filtering ({presence_filter}).")
 
     classify_d = presence_info.classify_d
-    hash_to_sample = presence_info.hash_to_sample
-
-    # collect hashes
-    hashes = list(sorted(hash_to_sample))
-
-    # collect samples
-    samples = set()
-    for h in hashes:
-        samples.update(hash_to_sample[h])
-    samples = list(sorted(samples))
-    sample_to_idx = {}
-    for i, sample_name in enumerate(samples):
-        sample_to_idx[sample_name] = i
-
+    hashes = presence_info.hashvals.tolist()
+    report.count(len(presence_info), 'hashes')
 
-    n_written = 0
-    with open(args.output, "w", newline="") as fp:
-        w = csv.writer(fp)
-        w.writerow(['query_name', 'match_name', 'presence'])
-
-        for hashval in hashes:
-            presence_j = hash_to_sample[hashval]
-
-            for sample_name in presence_j:
-                w.writerow([sample_name, hashval, 1])
-                n_written += 1
+    report.begin('write')
+    if args.parquet:
+        n_written = write_presence_parquet(args.output, presence_info)
+        print(f"wrote {n_written} entries to '{args.output}'")
+    else:
+        with open_export_file(args.output) as fp:
+            n_written = write_presence_csv(fp, presence_info)
 
         print(f"wrote {n_written} entries to '{args.output}'")
         print(f"use 'sourmash scripts clustermap1' from betterplot to plot!")
         print(f"e.g. 'sourmash scripts clustermap1 {args.output} -o fig.png -u presence --no-x-label'")
+    report.count(n_written, 'entries')
+
+    if args.output_matrix:
+        sample_names, hashvals, presence_mat = \
+            presence_info.build_presence_matrix(format='csr')
+        scipy.sparse.save_npz(args.output_matrix, presence_mat)
+        labels_file = args.output_matrix.removesuffix('.npz') + '.labels.npz'
+        numpy.savez(labels_file, sample_names=numpy.array(sample_names),
+                    hashvals=hashvals)
+        print(f"wrote {presence_mat.shape[0]} x {presence_mat.shape[1]} presence matrix to '{args.output_matrix}', labels to '{labels_file}'")
 
     if args.categories_csv:
         n_written = 0
@@ -88,6 +93,8 @@ def main():
 
         print(f"{n_written} category entries written to '{args.categories_csv}'")
 
+    report.close()
+
 
 if __name__ == '__main__':
    sys.exit(main())
@@ -3,154 +3,743 @@ Utilities for loading from & saving to files, as well as other common stuff.
 """
 import pickle
 import csv
+import gzip
+import hashlib
+import json
+import math
+import mmap
+import multiprocessing
+from multiprocessing import shared_memory
+import os
+import resource
+import sys
+import time
+import uuid
+import weakref
 import numpy
+import scipy.sparse
+import scipy.sparse.csgraph
 
 import sourmash
+from sourmash.minhash import _get_max_hash_for_scaled
+from sourmash.picklist import SignaturePicklist, PickStyle
 import sourmash_utils
 
+# magic bytes and version for the columnar presence file format.
+PRESENCE_FILE_MAGIC = b'HASHPRES'
+PRESENCE_FILE_VERSION = 1
+# byte alignment of each array in the columnar presence file format.
+_PRESENCE_FILE_ALIGN = 64
+
+# number of hash rows per tile in the blocked association computation.
+DEFAULT_BLOCK_SIZE = 2048
+
+# dtypes supported for association matrices; uint16 matrices store
+# Jaccard similarity quantized to 0..JACCARD_UINT16_SCALE.
+ASSOCIATION_DTYPES = ('float64', 'float32', 'float16', 'uint16')
+JACCARD_UINT16_SCALE = 65535
+
+# maximum number of sketches handed to a worker process at a time.
+MAX_SCAN_CHUNK_SIZE = 100
+
+# size in bytes of the unpacked blocks of sample rows converted at a time
+# by PresenceBitMatrix.to_presence_info.
+PRESENCE_UNPACK_BYTES = 2**26
+
+# magic bytes and version for SketchHashCache segment files, and the size
+# in bytes of new entries at which a segment is written.
+SKETCH_CACHE_MAGIC = b'HASHSEGM'
+SKETCH_CACHE_VERSION = 1
+SKETCH_CACHE_SEGMENT_SIZE = 2**27
+
+# default LSH banding for approximate nearest neighbors (knn_jaccard_graph);
+# MinHash signatures have bands * rows values.
+DEFAULT_LSH_BANDS = 32
+DEFAULT_LSH_ROWS = 2
+
 
 class HashPresenceInformation:
     """
     Store a hash presence table & their associated rank classifications.
+
+    Presence is stored in CSR form: 'hashvals' is a sorted uint64 array,
+    and the samples containing hashvals[i] are
+    sample_names[indices[indptr[i]:indptr[i+1]]]. A dictionary of
+    hashval => set of sample names is available as 'hash_to_sample', but
+    is only built on demand.
+
+    'scanned_md5s' records the md5sums of all sketches that were scanned
+    to build the table, including those with no hashes present.
+
+    Rank classifications are likewise stored as sorted arrays,
+    'classify_hashvals' and 'classify_types', and can be passed in that
+    way or as a 'classify_d' dictionary of hashval => rank; 'classify_d'
+    is built on demand.
     """
     def __init__(self, *, ksize=21, scaled=1000, moltype='DNA',
-                 classify_d=None, hash_to_sample=None):
+                 classify_d=None, hash_to_sample=None,
+                 hashvals=None, sample_names=None, indptr=None, indices=None,
+                 scanned_md5s=None, classify_hashvals=None,
+                 classify_types=None):
         self.ksize = ksize
         self.scaled = scaled
         self.moltype = moltype
-        self.classify_d = classify_d
-        self.hash_to_sample = hash_to_sample
+        self.scanned_md5s = list(sorted(set(scanned_md5s or [])))
+        self._hash_to_sample = None
+        self._classify_d = None
+        self._hash_types = None
+
+        if classify_d is not None:
+            assert classify_hashvals is None
+            classify_hashvals = numpy.fromiter(classify_d.keys(),
+                                               dtype=numpy.uint64,
+                                               count=len(classify_d))
+            classify_types = numpy.fromiter(classify_d.values(),
+                                            dtype=numpy.uint8,
+                                            count=len(classify_d))
+            order = numpy.argsort(classify_hashvals)
+            classify_hashvals = classify_hashvals[order]
+            classify_types = classify_types[order]
+        elif classify_hashvals is None:
+            classify_hashvals = []
+            classify_types = []
+
+        self.classify_hashvals = numpy.asarray(classify_hashvals,
+                                               dtype=numpy.uint64)
+        self.classify_types = numpy.asarray(classify_types, dtype=numpy.uint8)
+        assert len(self.classify_hashvals) == len(self.classify_types)
+
+        if hash_to_sample is not None:
+            assert hashvals is None
+            hashvals, sample_names, indptr, indices = \
+                csr_from_hash_to_sample(hash_to_sample)
+        elif hashvals is None:
+            hashvals = []
+            sample_names = []
+            indptr = [0]
+            indices = []
+
+        self.hashvals = numpy.asarray(hashvals, dtype=numpy.uint64)
+        self.sample_names = list(sample_names)
+        self.indptr = numpy.asarray(indptr, dtype=numpy.int64)
+        self.indices = numpy.asarray(indices)
+        if not numpy.issubdtype(self.indices.dtype, numpy.unsignedinteger):
+            self.indices = self.indices.astype(numpy.uint32)
+
+        assert len(self.indptr) == len(self.hashvals) + 1
+
+    def __len__(self):
+        return len(self.hashvals)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_hash_to_sample'] = None
+        state['_classify_d'] = None
+        state['_hash_types'] = None
+        return state
+
+    def __setstate__(self, state):
+        if 'hashvals' not in state:
+            # old-style pickle, with only a hash_to_sample dictionary.
+            state = dict(state)
+            hash_to_sample = state.pop('hash_to_sample')
+            self.__init__(hash_to_sample=hash_to_sample, **state)
+        elif 'classify_hashvals' not in state:
+            # pickle with a classify_d dictionary.
+            state = { k: v for k, v in state.items()
+                      if not k.startswith('_') }
+            self.__init__(**state)
+        else:
+            self.__dict__.update(state)
+
+    @property
+    def hash_to_sample(self):
+        "A (lazily built) dictionary of hashval => set of sample names."
+        if self._hash_to_sample is None:
+            sample_names = numpy.array(self.sample_names, dtype=object)
+            indptr = self.indptr
+            indices = self.indices
+
+            hash_to_sample = {}
+            for i, hashval in enumerate(self.hashvals.tolist()):
+                idx = indices[indptr[i]:indptr[i + 1]]
+                hash_to_sample[hashval] = set(sample_names[idx])
+            self._hash_to_sample = hash_to_sample
+
+        return self._hash_to_sample
+
+    @property
+    def classify_d(self):
+        "A (lazily built) dictionary of hashval => pangenome rank."
+        if self._classify_d is None:
+            self._classify_d = dict(zip(self.classify_hashvals.tolist(),
+                                        self.classify_types.tolist()))
+        return self._classify_d
+
+    @property
+    def hash_types(self):
+        "The pangenome rank of each hash in 'hashvals', or 0 if unclassified."
+        if self._hash_types is None:
+            class_hashvals = self.classify_hashvals
+            types = numpy.zeros(len(self.hashvals), dtype=numpy.uint8)
+            if len(class_hashvals):
+                pos = numpy.searchsorted(class_hashvals, self.hashvals)
+                pos = numpy.minimum(pos, len(class_hashvals) - 1)
+                found = class_hashvals[pos] == self.hashvals
+                types[found] = self.classify_types[pos[found]]
+            self._hash_types = types
+        return self._hash_types
+
+    def fingerprint(self):
+        "Return a hex digest identifying the presence table contents."
+        h = hashlib.sha256()
+        h.update(json.dumps([self.ksize, self.scaled, self.moltype,
+                             self.sample_names]).encode('utf-8'))
+        h.update(self.hashvals.astype('<u8').tobytes())
+        h.update(self.indptr.astype('<u8').tobytes())
+        h.update(self.indices.astype('<u4').tobytes())
+        return h.hexdigest()
+
+    @property
+    def sample_counts(self):
+        "The number of samples each hash is present in."
+        return numpy.diff(self.indptr)
+
+    @classmethod
+    def from_sample_hits(cls, sample_names, sample_hits, **kwargs):
+        """
+        Build an object from per-sample hit lists.
+
+        'sample_hits[i]' is an array of the hashes present in sample
+        'sample_names[i]'; samples may be repeated. Other keyword
+        arguments are passed through to the constructor.
+        """
+        names = list(sorted(set(sample_names)))
+        name_to_idx = { name: n for n, name in enumerate(names) }
+
+        sample_idx = numpy.array([ name_to_idx[name] for name in sample_names ],
+                                 dtype=numpy.uint32)
+        sample_idx = numpy.repeat(sample_idx,
+                                  [ len(hits) for hits in sample_hits ])
+        if sample_hits:
+            all_hashes = numpy.concatenate(sample_hits).astype(numpy.uint64)
+        else:
+            all_hashes = numpy.zeros(0, dtype=numpy.uint64)
+
+        hashvals, indptr, indices = csr_from_pairs(all_hashes, sample_idx)
+        return cls(hashvals=hashvals, sample_names=names, indptr=indptr,
+                   indices=indices, **kwargs)
 
     def _make_minhash_obj(self):
         return sourmash_utils.FracMinHash(ksize=self.ksize,
                                           moltype=self.moltype,
                                           scaled=self.scaled)
 
-    def downsample(self, new_scaled):
-        "Downsample hashes to a new scaled value."
-        if new_scaled < self.scaled:
-            raise ValueError(f"cannot downsample to {new_scaled}: current scaled is {self.scaled}")
+    def _select_rows(self, keep, *, scaled=None, classify_keep=None):
+        """
+        Return a new object containing only the hashes in boolean mask
+        'keep'. Rank classifications are kept for the hashes in mask
+        'classify_keep', or by default only for the kept hashes.
+        """
+        sample_counts = self.sample_counts
+        keep_entries = numpy.repeat(keep, sample_counts)
+        indptr = numpy.zeros(keep.sum() + 1, dtype=numpy.int64)
+        numpy.cumsum(sample_counts[keep], out=indptr[1:])
 
-        # downsample
-        mh = sourmash.MinHash(n=0, ksize=self.ksize, scaled=new_scaled)
-        mh.add_many(self.hash_to_sample)
+        hashvals = self.hashvals[keep]
+        if classify_keep is None:
+            classify_keep = numpy.isin(self.classify_hashvals, hashvals,
+                                       assume_unique=True)
 
-        # shift over the presence vectors
-        hashes = mh.hashes
-        hash_to_sample = self.hash_to_sample
-        new_d = {}
-        for hashval in hashes:
-            new_d[hashval] = hash_to_sample[hashval]
+        obj = HashPresenceInformation(ksize=self.ksize,
+                                      scaled=scaled or self.scaled,
+                                      moltype=self.moltype,
+                                      hashvals=hashvals,
+                                      sample_names=self.sample_names,
+                                      indptr=indptr,
+                                      indices=self.indices[keep_entries],
+                                      scanned_md5s=self.scanned_md5s,
+                                      classify_hashvals=self.classify_hashvals[classify_keep],
+                                      classify_types=self.classify_types[classify_keep])
+        obj._hash_types = self.hash_types[keep]
+        return obj
 
-        # CTB: could shift over the classify_d here too.
-        return HashPresenceInformation(ksize=self.ksize,
-                                       scaled=new_scaled,
-                                       moltype=self.moltype,
-                                       classify_d=self.classify_d,
-                                       hash_to_sample=new_d)
+    def check_compatible(self, *, ksize, scaled, moltype):
+        "Raise ValueError if ksize/scaled/moltype differ from this object's."
+        mine = (self.ksize, self.scaled, self.moltype)
+        theirs = (ksize, scaled, moltype)
+        if mine != theirs:
+            raise ValueError(f"incompatible presence information: k={ksize} scaled={scaled} moltype={moltype} does not match k={self.ksize} scaled={self.scaled} moltype={self.moltype}")
 
-    def filter_by_min_samples(self, min_presence):
-        "Keep only hashes in a minimum of 'min_presence' samples."
-        new_d = {}
-        hash_to_sample = self.hash_to_sample
-        for hashval, presence in hash_to_sample.items():
-            if len(presence) >= min_presence:
-                new_d[hashval] = presence
+    def merge(self, other):
+        """
+        Combine the presence information in this object with 'other'.
+
+        Both must have the same ksize/scaled/moltype and compatible rank
+        classifications; samples present in both are merged by name.
+        """
+        self.check_compatible(ksize=other.ksize, scaled=other.scaled,
+                              moltype=other.moltype)
+
+        classify_from = self
+        if len(self.classify_hashvals) and len(other.classify_hashvals):
+            if not (numpy.array_equal(self.classify_hashvals,
+                                      other.classify_hashvals) and
+                    numpy.array_equal(self.classify_types,
+                                      other.classify_types)):
+                raise ValueError("incompatible presence information: rank classifications differ")
+        elif not len(self.classify_hashvals):
+            classify_from = other
+
+        names = list(sorted(set(self.sample_names) | set(other.sample_names)))
+        name_to_idx = { name: n for n, name in enumerate(names) }
 
-        # CTB: could filter classify_d here too.
+        hashes = []
+        sample_idx = []
+        for obj in (self, other):
+            remap = numpy.array([ name_to_idx[name] for name in obj.sample_names ],
+                                dtype=numpy.uint32)
+            hashes.append(numpy.repeat(obj.hashvals, obj.sample_counts))
+            sample_idx.append(remap[obj.indices] if len(remap) else
+                              numpy.zeros(0, dtype=numpy.uint32))
+
+        hashvals, indptr, indices = csr_from_pairs(numpy.concatenate(hashes),
+                                                   numpy.concatenate(sample_idx))
 
         return HashPresenceInformation(ksize=self.ksize,
                                        scaled=self.scaled,
                                        moltype=self.moltype,
-                                       classify_d=self.classify_d,
-                                       hash_to_sample=new_d)
+                                       hashvals=hashvals,
+                                       sample_names=names,
+                                       indptr=indptr,
+                                       indices=indices,
+                                       scanned_md5s=self.scanned_md5s + other.scanned_md5s,
+                                       classify_hashvals=classify_from.classify_hashvals,
+                                       classify_types=classify_from.classify_types)
+
+    def downsample(self, new_scaled):
+        "Downsample hashes to a new scaled value."
+        return PresenceFilter(scaled=new_scaled).apply(self)
+
+    def filter_by_min_samples(self, min_presence):
+        "Keep only hashes in a minimum of 'min_presence' samples."
+        return PresenceFilter(min_presence=min_presence).apply(self)
 
     def filter_by_pangenome_type(self, typelist):
         "Keep only hashes with specific pangenome ranks."
-        assert min(typelist) >= 1
-        assert max(typelist) <= 5
+        return PresenceFilter(pangenome_types=typelist).apply(self)
 
-        new_d = {}
-        hash_to_sample = self.hash_to_sample
-        classify_d = self.classify_d
-        for hashval, presence in hash_to_sample.items():
-            if classify_d.get(hashval) in typelist:
-                new_d[hashval] = presence
+    def subsample(self, n, *, seed=42):
+        "Keep a random subset of at most 'n' hashes."
+        keep = numpy.zeros(len(self.hashvals), dtype=bool)
+        rng = numpy.random.default_rng(seed)
+        keep[rng.choice(len(keep), size=min(n, len(keep)), replace=False)] = True
+        return self._select_rows(keep)
 
-        # CTB: could filter classify_d here too.
+    def collapse_identical(self):
+        """
+        Collapse hashes with identical sample sets into classes, keeping
+        the first hash of each class; see group_identical_rows.
 
-        return HashPresenceInformation(ksize=self.ksize,
-                                       scaled=self.scaled,
-                                       moltype=self.moltype,
-                                       classify_d=self.classify_d,
-                                       hash_to_sample=new_d)
+        Returns (collapsed, inverse, counts): a new object with one hash
+        per class, the class of each hash, and the size of each class.
+        """
+        first, inverse, counts = group_identical_rows(self.indptr,
+                                                      self.indices)
+        keep = numpy.zeros(len(self.hashvals), dtype=bool)
+        keep[first] = True
+        return self._select_rows(keep), inverse, counts
 
-    def build_association_matrix(self):
-        hash_to_sample = self.hash_to_sample
+    def build_association_matrix(self, *, block_size=DEFAULT_BLOCK_SIZE,
+                                 dtype=float, out=None, cores=1,
+                                 collapse=False):
+        """
+        Build a square matrix of Jaccard similarities between hash presence sets.
 
-        hashvals = list(sorted(hash_to_sample))
+        'dtype' is one of ASSOCIATION_DTYPES; if 'out' is given, the matrix
+        is written into it (e.g. a memmap from open_association_memmap)
+        rather than allocated in memory. With cores > 1, tiles are
+        computed by a pool of processes. With 'collapse', similarities are
+        computed once per class of identical presence sets and then
+        expanded to all hashes.
+        """
+        if collapse:
+            collapsed, inverse, counts = self.collapse_identical()
+            print(f"collapsed {len(self)} hashes into {len(collapsed)} classes of identical presence sets.")
+            _, cmp = collapsed.build_association_matrix(block_size=block_size,
+                                                        dtype=dtype,
+                                                        cores=cores)
+            return self.hashvals.tolist(), expand_matrix(cmp, inverse, out=out)
+
+        hashvals = self.hashvals.tolist()
         print(f"creating {len(hashvals)} by {len(hashvals)} array.")
 
-        cmp = numpy.zeros((len(hashvals), len(hashvals)), dtype=float)
+        packed = pack_presence_csr(self.indptr, self.indices,
+                                   len(self.sample_names))
+        cmp = jaccard_from_packed(packed, n_samples=len(self.sample_names),
+                                  block_size=block_size, dtype=dtype, out=out,
+                                  cores=cores)
+
+        return hashvals, cmp
+
+    def write_association_matrix(self, filename, *, dtype=float,
+                                 block_size=DEFAULT_BLOCK_SIZE, cores=1):
+        """
+        Compute the square Jaccard similarity matrix out of core, into the
+        '.npy' file 'filename', in tiles of 'block_size' rows; see
+        write_association_file. Returns the list of hashvals.
+        """
+        hashvals = self.hashvals.tolist()
+        n_samples = len(self.sample_names)
+        print(f"writing {len(hashvals)} by {len(hashvals)} array to '{filename}' in tiles of {block_size}.")
+
+        packed = pack_presence_csr(self.indptr, self.indices, n_samples)
+        write_association_file(filename, packed, n_samples=n_samples,
+                               dtype=dtype, block_size=block_size,
+                               fingerprint=self.fingerprint(), cores=cores)
+
+        return hashvals
 
-        for i in range(len(hashvals)):
-            hash_i = hashvals[i]
-            presence_i = hash_to_sample[hash_i]
+    def build_sparse_association_matrix(self, *, threshold=None, top_k=None,
+                                        block_size=DEFAULT_BLOCK_SIZE):
+        """
+        Build a sparse matrix of Jaccard similarities between hash presence
+        sets, keeping only pairs with similarity >= 'threshold' plus the
+        'top_k' most similar hashes for each hash.
+        """
+        hashvals = self.hashvals.tolist()
+        print(f"creating sparse {len(hashvals)} by {len(hashvals)} array (threshold={threshold}, top_k={top_k}).")
 
-            for j in range(i):
-                hash_j = hashvals[j]
-                presence_j = hash_to_sample[hash_j]
-                jaccard = len(presence_i.intersection(presence_j)) / \
-                    len(presence_i.union(presence_j))
-                cmp[i][j] = jaccard
-                cmp[j][i] = jaccard
+        packed = pack_presence_csr(self.indptr, self.indices,
+                                   len(self.sample_names))
+        cmp = sparse_jaccard_from_packed(packed,
+                                         n_samples=len(self.sample_names),
+                                         threshold=threshold, top_k=top_k,
+                                         block_size=block_size)
+        print(f"kept {cmp.nnz} entries ({cmp.nnz / max(len(hashvals), 1)**2:.2%}).")
 
-            cmp[i][i] = 1
+        return hashvals, cmp
+
+    def build_knn_association_matrix(self, *, k, bands=DEFAULT_LSH_BANDS,
+                                     rows=DEFAULT_LSH_ROWS, seed=1):
+        """
+        Build an approximate sparse matrix of Jaccard similarities between
+        hash presence sets, keeping the k nearest neighbors of each hash;
+        see knn_jaccard_graph.
+        """
+        hashvals = self.hashvals.tolist()
+        print(f"creating approximate {k}-nearest-neighbor graph of {len(hashvals)} hashes (LSH with {bands} bands of {rows}).")
+
+        packed = pack_presence_csr(self.indptr, self.indices,
+                                   len(self.sample_names))
+        cmp = knn_jaccard_graph(packed, self.indptr, self.indices,
+                                n_samples=len(self.sample_names), k=k,
+                                bands=bands, rows=rows, seed=seed)
+        print(f"kept {cmp.nnz} entries ({cmp.nnz / max(len(hashvals), 1)**2:.2%}).")
 
         return hashvals, cmp
 
-    def build_presence_matrix(self):
-        # get list of samples:
-        all_samples = set()
-        for k, vv in self.hash_to_sample.items():
-            all_samples.update(vv)
+    def build_approximate_association_matrix(self, *, threshold,
+                                             recall=0.95, max_hashes=256,
+                                             signature=None, seed=1):
+        """
+        Build a sparse matrix of the pairs of hashes with Jaccard similarity
+        >= 'threshold', found approximately with MinHash LSH at the given
+        expected 'recall'; see lsh_jaccard_matrix.
+        """
+        hashvals = self.hashvals.tolist()
+        print(f"creating approximate sparse {len(hashvals)} by {len(hashvals)} array (threshold={threshold}, recall={recall}).")
+
+        packed = pack_presence_csr(self.indptr, self.indices,
+                                   len(self.sample_names))
+        cmp, (bands, rows, signature) = lsh_jaccard_matrix(
+            packed, self.indptr, self.indices,
+            n_samples=len(self.sample_names), threshold=threshold,
+            recall=recall, max_hashes=max_hashes, signature=signature,
+            seed=seed)
+        print(f"used LSH with {bands} bands of {rows} {signature} values; expected recall is {lsh_recall(threshold, bands, rows):.3f} at similarity {threshold}, {lsh_recall(min(1, threshold + 0.1), bands, rows):.3f} at {min(1, threshold + 0.1):.2f}.")
+        print(f"kept {cmp.nnz} entries ({cmp.nnz / max(len(hashvals), 1)**2:.2%}).")
 
-        print(f"got {len(all_samples)} samples for presence plot.")
+        return hashvals, cmp
+
+    def build_presence_matrix(self, *, format='float'):
+        """
+        Build a sample x hash presence matrix over the samples that contain
+        at least one hash, with rows in sorted sample name order and columns
+        in hashval order; see presence_matrix_from_csr for 'format'.
 
-        sample_to_idx = {}
-        for n, sample_name in enumerate(sorted(all_samples)):
-            sample_to_idx[sample_name] = n
+        Returns (sample_names, hashvals, matrix).
+        """
+        # get list of samples that are actually used:
+        used = _sorted_unique(self.indices)
+        sample_names = numpy.array(self.sample_names, dtype=object)[used]
+        order = numpy.argsort(sample_names)
 
-        hashval_to_idx = {}
-        for n, hashval in enumerate(self.hash_to_sample):
-            hashval_to_idx[hashval] = n
+        print(f"got {len(used)} samples for presence plot.")
 
-        print(f"creating presence matrix: {len(sample_to_idx)} x {len(hashval_to_idx)}")
-        presence_mat = numpy.zeros((len(sample_to_idx), len(hashval_to_idx)))
+        # map sample table indices => sorted presence matrix rows
+        sample_row = numpy.zeros(len(self.sample_names), dtype=numpy.intp)
+        sample_row[used[order]] = numpy.arange(len(used))
 
-        for hashval, sample_set in self.hash_to_sample.items():
-            hashval_i = hashval_to_idx[hashval]
-            for sample_name in sample_set:
-                sample_j = sample_to_idx[sample_name]
+        print(f"creating {format} presence matrix: {len(used)} x {len(self.hashvals)}")
+        presence_mat = presence_matrix_from_csr(self.indptr,
+                                                sample_row[self.indices],
+                                                len(used), format=format)
 
-                presence_mat[sample_j][hashval_i] = 1
+        return sample_names[order].tolist(), self.hashvals, presence_mat
 
-        return sample_to_idx, hashval_to_idx, presence_mat
-        
     def save_to_file(self, filename):
-        "Save an object of this class to a file."
-        with open(filename, 'wb') as fp:
-            pickle.dump(self, fp)
+        "Save an object of this class to a file in the columnar format."
+        write_presence_file(filename, self)
 
     @classmethod
-    def load_from_file(cls, filename):
-        "Load an object of this class from a file."
-        with open(filename, 'rb') as fp:
-            obj = pickle.load(fp)
-        assert isinstance(obj, cls)
+    def load_from_file(cls, filename, presence_filter=None, *, view_dir=None):
+        """
+        Load an object of this class from a file.
+
+        Reads both the columnar format and older pickled dumps. If a
+        PresenceFilter is given, it is applied while loading; with
+        'view_dir', the filtered result is saved there as a view keyed by
+        the file and filter parameters, and reused by later loads.
+        """
+        if presence_filter is None:
+            presence_filter = PresenceFilter()
+
+        view_filename = None
+        if view_dir is not None and presence_filter:
+            view_filename = os.path.join(view_dir,
+                                         presence_filter.view_name(filename))
+            if os.path.exists(view_filename):
+                return PresenceFile(view_filename).read()
+
+        if is_presence_file(filename):
+            pfile = PresenceFile(filename)
+            # hashvals are sorted, so downsampling only needs a prefix.
+            stop = None
+            if presence_filter.scaled:
+                max_hash = _get_max_hash_for_scaled(presence_filter.scaled)
+                stop = int(numpy.searchsorted(pfile.hashvals,
+                                              numpy.uint64(max_hash),
+                                              side='right'))
+            obj = pfile.read(stop=stop)
+        else:
+            with open(filename, 'rb') as fp:
+                obj = pickle.load(fp)
+            assert isinstance(obj, cls)
+
+        if presence_filter:
+            obj = presence_filter.apply(obj)
+        if view_filename is not None:
+            os.makedirs(view_dir, exist_ok=True)
+            obj.save_to_file(view_filename)
         return obj
 
 
+class PresenceFilter:
+    """
+    A lazily applied chain of presence filters.
+
+    downsample, filter_by_min_samples and filter_by_pangenome_type record
+    a filter and return a new PresenceFilter; nothing is computed until
+    'apply', which combines all of the filters into a single row mask.
+    """
+    def __init__(self, *, scaled=None, min_presence=None,
+                 pangenome_types=None):
+        self.scaled = scaled
+        self.min_presence = min_presence
+        if pangenome_types is not None:
+            pangenome_types = sorted(set(pangenome_types))
+            assert all(1 <= t <= 5 for t in pangenome_types)
+        self.pangenome_types = pangenome_types
+
+    def _params(self):
+        return dict(scaled=self.scaled, min_presence=self.min_presence,
+                    pangenome_types=self.pangenome_types)
+
+    def _replace(self, **kwargs):
+        params = self._params()
+        params.update(kwargs)
+        return PresenceFilter(**params)
+
+    def downsample(self, new_scaled):
+        "Add downsampling to 'new_scaled'."
+        return self._replace(scaled=max(new_scaled, self.scaled or 0))
+
+    def filter_by_min_samples(self, min_presence):
+        "Add a filter for hashes in at least 'min_presence' samples."
+        return self._replace(min_presence=max(min_presence,
+                                              self.min_presence or 0))
+
+    def filter_by_pangenome_type(self, typelist):
+        "Add a filter for hashes with the pangenome ranks in 'typelist'."
+        if self.pangenome_types is not None:
+            typelist = set(typelist) & set(self.pangenome_types)
+        return self._replace(pangenome_types=typelist)
+
+    def __bool__(self):
+        return any(v is not None for v in self._params().values())
+
+    def __str__(self):
+        return ", ".join(f"{k}={v}" for k, v in self._params().items()
+                         if v is not None) or "no filters"
+
+    def view_name(self, filename):
+        """
+        Return a filename for the view of 'filename' with these filters;
+        it changes if the file or the filter parameters change.
+        """
+        st = os.stat(filename)
+        key = dict(source=os.path.realpath(filename), size=st.st_size,
+                   mtime_ns=st.st_mtime_ns, filters=self._params())
+        digest = hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8'))
+        return f"{os.path.basename(filename)}.{digest.hexdigest()[:16]}.view"
+
+    def apply(self, presence_info):
+        "Return 'presence_info' with all of the filters applied in one pass."
+        keep = numpy.ones(len(presence_info), dtype=bool)
+        classify_keep = numpy.ones(len(presence_info.classify_hashvals),
+                                   dtype=bool)
+        scaled = None
+
+        if self.scaled:
+            if self.scaled < presence_info.scaled:
+                raise ValueError(f"cannot downsample to {self.scaled}: current scaled is {presence_info.scaled}")
+            max_hash = numpy.uint64(_get_max_hash_for_scaled(self.scaled))
+            keep &= presence_info.hashvals <= max_hash
+            classify_keep = presence_info.classify_hashvals <= max_hash
+            scaled = self.scaled
+
+        if self.min_presence is not None:
+            keep &= presence_info.sample_counts >= self.min_presence
+            classify_keep = None
+
+        if self.pangenome_types is not None:
+            keep &= numpy.isin(presence_info.hash_types, self.pangenome_types)
+            classify_keep = None
+
+        return presence_info._select_rows(keep, scaled=scaled,
+                                          classify_keep=classify_keep)
+
+
+class PresenceBitMatrix:
+    """
+    A growable sample x hash presence matrix, with one bit per query hash.
+
+    Bit (pos % 8) of byte (pos // 8) in row i is set if query hash 'pos'
+    is present in sample_names[i].
+    """
+    def __init__(self, hashvals, *, n_samples=0):
+        self.hashvals = _sorted_unique(numpy.asarray(hashvals,
+                                                     dtype=numpy.uint64))
+        self.sample_names = []
+        n_bytes = max(1, (len(self.hashvals) + 7) // 8)
+        self.bits = numpy.zeros((max(n_samples, 1), n_bytes), dtype=numpy.uint8)
+
+    def __len__(self):
+        return len(self.sample_names)
+
+    def add_sample(self, name, positions):
+        "Record the query hash positions 'positions' as present in 'name'."
+        row = len(self.sample_names)
+        if row == len(self.bits):
+            self.bits = numpy.concatenate([self.bits,
+                                           numpy.zeros_like(self.bits)])
+
+        positions = numpy.asarray(positions, dtype=numpy.intp)
+        bitvals = numpy.left_shift(1, positions & 7).astype(numpy.uint8)
+        numpy.bitwise_or.at(self.bits[row], positions >> 3, bitvals)
+        self.sample_names.append(name)
+
+    def to_presence_info(self, *, max_bytes=PRESENCE_UNPACK_BYTES, **kwargs):
+        """
+        Convert into a HashPresenceInformation object, unpacking blocks of
+        sample rows of at most 'max_bytes' bytes (one byte per hash) at a
+        time.
+
+        Other keyword arguments are passed through to the constructor.
+        """
+        names = list(sorted(set(self.sample_names)))
+        name_to_idx = { name: n for n, name in enumerate(names) }
+        row_to_idx = numpy.array([ name_to_idx[name] for name in self.sample_names ],
+                                 dtype=numpy.uint32)
+
+        block_size = max(1, max_bytes // max(len(self.hashvals), 1))
+        hash_pos = []
+        sample_idx = []
+        for start in range(0, len(self), block_size):
+            end = min(start + block_size, len(self))
+            block = numpy.unpackbits(self.bits[start:end], axis=1,
+                                     count=len(self.hashvals),
+                                     bitorder='little')
+            rows, cols = numpy.nonzero(block)
+            hash_pos.append(cols)
+            sample_idx.append(row_to_idx[rows + start])
+
+        if hash_pos:
+            hashes = self.hashvals[numpy.concatenate(hash_pos)]
+            sample_idx = numpy.concatenate(sample_idx)
+        else:
+            hashes = numpy.zeros(0, dtype=numpy.uint64)
+            sample_idx = numpy.zeros(0, dtype=numpy.uint32)
+
+        hashvals, indptr, indices = csr_from_pairs(hashes, sample_idx)
+        return HashPresenceInformation(hashvals=hashvals, sample_names=names,
+                                       indptr=indptr, indices=indices,
+                                       **kwargs)
+
+
+class PangenomeQueries:
+    """
+    The query hashes of several pangenomes, combined into one sorted array
+    so that a sketch collection can be scanned once for all of them.
+
+    'hashvals' is the combined query; split_hits() maps positions in it
+    back to positions in each pangenome's own sorted query, 'queries[i]'.
+    A hash may belong to more than one pangenome.
+    """
+    def __init__(self, queries):
+        self.queries = [ _sorted_unique(numpy.asarray(q, dtype=numpy.uint64))
+                         for q in queries ]
+        sizes = [ len(q) for q in self.queries ]
+        all_hashes = numpy.concatenate(self.queries) if self.queries else \
+            numpy.zeros(0, dtype=numpy.uint64)
+        owner = numpy.repeat(numpy.arange(len(sizes), dtype=numpy.uint32),
+                             sizes)
+        local = numpy.concatenate([ numpy.arange(n, dtype=numpy.uint32)
+                                    for n in sizes ] or [[]])
+
+        # group the (hash, pangenome, local position) entries by hash, in
+        # CSR form over the combined hash array.
+        order = numpy.argsort(all_hashes, kind='stable')
+        all_hashes = all_hashes[order]
+        starts = numpy.ones(len(all_hashes), dtype=bool)
+        starts[1:] = all_hashes[1:] != all_hashes[:-1]
+        self.hashvals = all_hashes[starts]
+        self._indptr = numpy.append(numpy.flatnonzero(starts), len(all_hashes))
+        self._owner = owner[order]
+        self._local = local[order]
+
+    def __len__(self):
+        return len(self.queries)
+
+    def split_hits(self, positions):
+        """
+        Split positions in the combined 'hashvals' into positions in each
+        pangenome's query. Returns a list with one sorted uint32 array per
+        pangenome.
+        """
+        positions = numpy.asarray(positions, dtype=numpy.intp)
+        counts = self._indptr[positions + 1] - self._indptr[positions]
+        entries = numpy.repeat(self._indptr[positions] - numpy.cumsum(counts)
+                               + counts, counts) + numpy.arange(counts.sum())
+
+        owner = self._owner[entries]
+        order = numpy.argsort(owner, kind='stable')
+        bounds = numpy.searchsorted(owner[order], numpy.arange(len(self) + 1))
+        local = self._local[entries[order]]
+        return [ local[bounds[i]:bounds[i + 1]] for i in range(len(self)) ]
+
+
 def read_ranktable_csv(filename):
     "Read a ranktable CSV."
     with open(filename, 'r', newline='') as fp:
@@ -163,3 +752,2330 @@ def read_ranktable_csv(filename):
             classify_d[hashval] = classify_as
 
         return classify_d
+
+
+#
+# sketch scanning
+#
+
+# per-worker state for scan_sketches, set by _init_scan_worker.
+_scan_query = None
+_scan_filter_names = None
+_scan_cache = None
+
+
+def _init_scan_worker(query, filter_names, cache_dir):
+    global _scan_query, _scan_filter_names, _scan_cache
+    _scan_query = query
+    _scan_filter_names = filter_names
+    if cache_dir is not None:
+        _scan_cache = SketchHashCache(cache_dir)
+
+
+def minhash_to_array(mh):
+    "Return the hashes in a MinHash as a sorted uint64 array."
+    hashes = mh.hashes
+    arr = numpy.fromiter(hashes, dtype=numpy.uint64, count=len(hashes))
+    arr.sort()
+    return arr
+
+
+def find_query_positions(query, hashes):
+    """
+    Find which of the sorted array 'hashes' are in the sorted array 'query'.
+
+    Returns the positions in 'query' of the matching hashes, as uint32.
+    """
+    if not len(query):
+        return numpy.zeros(0, dtype=numpy.uint32)
+    pos = numpy.searchsorted(query, hashes)
+    pos[pos == len(query)] = 0
+    found = query[pos] == hashes
+    return pos[found].astype(numpy.uint32)
+
+
+def _scan_signatures(idx, *, scaled, query, filter_names, cache=None):
+    "Yield (name, md5, hits) for each signature in 'idx'."
+    for ss in idx.signatures():
+        name = ss.name
+        md5 = ss.md5sum()
+        if filter_names is not None and name not in filter_names:
+            yield name, md5, None
+            continue
+
+        mh = ss.minhash
+        hits = None
+        if cache is not None:
+            hits = cache.get(md5, mh.ksize, scaled or mh.scaled)
+        if hits is None:
+            hits = minhash_to_array(mh.downsample(scaled=scaled))
+            if cache is not None:
+                cache.add(md5, mh.ksize, scaled or mh.scaled, hits)
+        if query is not None:
+            hits = find_query_positions(query, hits)
+
+        yield name, md5, hits
+
+
+def _scan_sketch_chunk(task):
+    "Scan the signatures with the given md5s in one file (in a worker)."
+    filename, select_params, md5s, skip_md5s, scaled = task
+    select_mh = sourmash_utils.FracMinHash(**select_params)
+    idx = load_sketches(filename, select_mh, skip_md5s=skip_md5s)
+    if md5s is not None:
+        picklist = SignaturePicklist('md5')
+        picklist.init(md5s)
+        idx = idx.select(picklist=picklist)
+
+    results = list(_scan_signatures(idx, scaled=scaled, query=_scan_query,
+                                    filter_names=_scan_filter_names,
+                                    cache=_scan_cache))
+    if _scan_cache is not None:
+        _scan_cache.flush()
+    return results
+
+
+def load_sketches(filename, select_mh, *, skip_md5s=None):
+    """
+    Load the sketches in 'filename' compatible with 'select_mh', excluding
+    any with md5sums in 'skip_md5s'.
+    """
+    idx = sourmash_utils.load_index_and_select(filename, select_mh)
+    if skip_md5s:
+        picklist = SignaturePicklist('md5', pickstyle=PickStyle.EXCLUDE)
+        picklist.init(skip_md5s)
+        idx = idx.select(picklist=picklist)
+    return idx
+
+
+def select_sketches_by_name(idx, names):
+    """
+    Restrict 'idx' to the signatures named in 'names' with a picklist on
+    its manifest, so that the other signatures are never loaded.
+
+    Returns (idx, skipped), with 'skipped' the (name, md5) of each
+    manifest row left out. An index without a manifest, or with unnamed
+    signatures (which sourmash picklists can't match), is returned as is,
+    with 'skipped' None.
+    """
+    if idx.manifest is None or not all(row['name'] for row in idx.manifest.rows):
+        return idx, None
+
+    skipped = [ (row['name'], row['md5']) for row in idx.manifest.rows
+                if row['name'] not in names ]
+    picklist = SignaturePicklist('name')
+    picklist.init([ name for name in names if name ])
+    return idx.select(picklist=picklist), skipped
+
+
+def split_cached_sketches(idx, cache, scaled):
+    """
+    Restrict 'idx' to the signatures whose hashes at 'scaled' are not in
+    'cache', with a picklist on its manifest, so that the cached
+    signatures are never loaded.
+
+    Returns (idx, cached), with 'cached' the (name, md5, hashes) of each
+    manifest row found in the cache. An index without a manifest is
+    returned as is, with 'cached' empty.
+    """
+    if idx.manifest is None:
+        return idx, []
+
+    cached = []
+    for row in idx.manifest.rows:
+        hashes = cache.get(row['md5'], row['ksize'], scaled or row['scaled'])
+        if hashes is not None:
+            cached.append((row['name'], row['md5'], hashes))
+
+    if cached:
+        picklist = SignaturePicklist('md5', pickstyle=PickStyle.EXCLUDE)
+        picklist.init(set(md5 for _, md5, _ in cached))
+        idx = idx.select(picklist=picklist)
+    return idx, cached
+
+
+def scan_sketches(filenames, select_mh, *, scaled, query_hashes=None,
+                  filter_names=None, skip_md5s=None, cores=1, cache=None):
+    """
+    Find the hashes present in each sketch in 'filenames' at 'scaled'.
+
+    Yields (name, md5, hits) for each sketch compatible with 'select_mh'.
+    'hits' is None if 'name' is not in 'filter_names'; otherwise it is
+    a sorted uint64 array of the sketch's hashes or, if 'query_hashes'
+    is given, the uint32 positions in (sorted) 'query_hashes' of the
+    query hashes present in the sketch. Sketches with md5sums in
+    'skip_md5s' are not loaded at all, and neither are sketches not in
+    'filter_names' if the file has a manifest.
+
+    If 'cache' (a SketchHashCache) is given, the downsampled hashes of
+    each sketch are read from it when present and added to it otherwise;
+    cached sketches in a file with a manifest are not loaded at all.
+
+    With cores > 1, the sketches in each file are split into chunks by
+    manifest and scanned by a pool of worker processes; results are
+    yielded in manifest order, after any skipped or cached sketches.
+    """
+    query = None
+    if query_hashes is not None:
+        query = _sorted_unique(numpy.asarray(query_hashes, dtype=numpy.uint64))
+
+    def load_and_filter(filename):
+        idx = load_sketches(filename, select_mh, skip_md5s=skip_md5s)
+        skipped = None
+        if filter_names is not None:
+            idx, skipped = select_sketches_by_name(idx, filter_names)
+        cached = []
+        if cache is not None:
+            idx, cached = split_cached_sketches(idx, cache, scaled)
+        return idx, skipped or [], cached
+
+    def scan_cached(cached):
+        for name, md5, hashes in cached:
+            if filter_names is not None and name not in filter_names:
+                yield name, md5, None
+                continue
+            if query is not None:
+                hashes = find_query_positions(query, hashes)
+            yield name, md5, hashes
+
+    def close_cache():
+        if cache is not None:
+            cache.flush()
+            cache.evict()
+
+    if cores <= 1:
+        for filename in filenames:
+            idx, skipped, cached = load_and_filter(filename)
+            for name, md5 in skipped:
+                yield name, md5, None
+            yield from scan_cached(cached)
+            yield from _scan_signatures(idx, scaled=scaled, query=query,
+                                        filter_names=filter_names,
+                                        cache=cache)
+        close_cache()
+        return
+
+    select_params = dict(ksize=select_mh.ksize,
+                         moltype=select_mh.moltype,
+                         scaled=select_mh.scaled,
+                         track_abundance=select_mh.track_abundance)
+
+    tasks = []
+    for filename in filenames:
+        idx, skipped, cached = load_and_filter(filename)
+        for name, md5 in skipped:
+            yield name, md5, None
+        yield from scan_cached(cached)
+        if idx.manifest is None:
+            tasks.append((filename, select_params, None, skip_md5s, scaled))
+            continue
+
+        md5s = list(dict.fromkeys(row['md5'] for row in idx.manifest.rows))
+        chunk_size = math.ceil(len(md5s) / (cores * 4))
+        chunk_size = max(1, min(chunk_size, MAX_SCAN_CHUNK_SIZE))
+        for start in range(0, len(md5s), chunk_size):
+            tasks.append((filename, select_params,
+                          md5s[start:start + chunk_size], None, scaled))
+
+    cache_dir = cache.cache_dir if cache is not None else None
+    with multiprocessing.Pool(cores, initializer=_init_scan_worker,
+                              initargs=(query, filter_names,
+                                        cache_dir)) as pool:
+        for results in pool.imap(_scan_sketch_chunk, tasks):
+            yield from results
+    close_cache()
+
+
+def csr_from_pairs(hashes, sample_idx):
+    """
+    Convert parallel arrays of (hashval, sample index) pairs into CSR arrays.
+
+    Repeated pairs are dropped. Returns (hashvals, indptr, indices).
+    """
+    order = numpy.lexsort((sample_idx, hashes))
+    hashes = hashes[order]
+    sample_idx = sample_idx[order]
+
+    keep = numpy.ones(len(hashes), dtype=bool)
+    keep[1:] = (hashes[1:] != hashes[:-1]) | \
+        (sample_idx[1:] != sample_idx[:-1])
+    hashes = hashes[keep]
+    sample_idx = sample_idx[keep]
+
+    hashvals, counts = numpy.unique(hashes, return_counts=True)
+    indptr = numpy.zeros(len(hashvals) + 1, dtype=numpy.int64)
+    numpy.cumsum(counts, out=indptr[1:])
+
+    return hashvals, indptr, sample_idx.astype(numpy.uint32)
+
+
+def csr_from_hash_to_sample(hash_to_sample):
+    """
+    Convert a dictionary of hashval => set of sample names into CSR arrays.
+
+    Returns (hashvals, sample_names, indptr, indices), with hashvals and
+    sample_names sorted and sample indices sorted within each hash.
+    """
+    hashvals = list(sorted(hash_to_sample))
+
+    all_samples = set()
+    for presence in hash_to_sample.values():
+        all_samples.update(presence)
+    sample_names = list(sorted(all_samples))
+    sample_to_idx = { name: n for n, name in enumerate(sample_names) }
+
+    indptr = numpy.zeros(len(hashvals) + 1, dtype=numpy.int64)
+    indices = numpy.empty(sum(map(len, hash_to_sample.values())),
+                          dtype=numpy.uint32)
+    pos = 0
+    for i, hashval in enumerate(hashvals):
+        presence = sorted(sample_to_idx[name] for name in hash_to_sample[hashval])
+        indices[pos:pos + len(presence)] = presence
+        pos += len(presence)
+        indptr[i + 1] = pos
+
+    hashvals = numpy.array(hashvals, dtype=numpy.uint64)
+    return hashvals, sample_names, indptr, indices
+
+
+def presence_row_keys(indptr, indices, *, seed=1):
+    """
+    Compute a 64-bit key for each CSR presence row: the sum, modulo 2**64,
+    of a random 64-bit value per sample. Identical rows get the same key;
+    different rows collide with probability about 2**-64.
+    """
+    n_samples = int(indices.max()) + 1 if len(indices) else 0
+    rng = numpy.random.default_rng(seed)
+    sample_keys = numpy.frombuffer(rng.bytes(8 * n_samples), dtype=numpy.uint64)
+
+    # uint64 arithmetic wraps around, so differences of the running sums
+    # are the per-row sums.
+    sums = numpy.zeros(len(indices) + 1, dtype=numpy.uint64)
+    numpy.cumsum(sample_keys[indices], out=sums[1:])
+    return sums[indptr[1:]] - sums[indptr[:-1]]
+
+
+def _rows_differ(indptr, indices, rows, other_rows):
+    """
+    Compare CSR rows 'rows' with rows 'other_rows' of the same lengths,
+    returning a boolean array that is True where they differ.
+    """
+    lengths = indptr[rows + 1] - indptr[rows]
+    row_id = numpy.repeat(numpy.arange(len(rows)), lengths)
+    offset = numpy.arange(len(row_id)) - numpy.repeat(numpy.cumsum(lengths) -
+                                                      lengths, lengths)
+    differ = indices[indptr[rows][row_id] + offset] != \
+        indices[indptr[other_rows][row_id] + offset]
+    return numpy.bincount(row_id, weights=differ, minlength=len(rows)) > 0
+
+
+def group_identical_rows(indptr, indices, *, seed=1):
+    """
+    Group identical CSR presence rows (with sorted indices) into classes,
+    by their presence_row_keys. Classes are checked exactly, so a key
+    collision only leaves rows uncollapsed.
+
+    Returns (first, inverse, counts): the first row of each class, in row
+    order; the class of each row; and the number of rows in each class.
+    """
+    n_rows = len(indptr) - 1
+    lengths = numpy.diff(indptr)
+    keys = presence_row_keys(indptr, indices, seed=seed)
+
+    # sort by (length, key); the sort is stable, so the first row of each
+    # run of equal keys is the lowest numbered one.
+    order = numpy.lexsort((keys, lengths))
+    sorted_keys = keys[order]
+    sorted_lengths = lengths[order]
+    starts = numpy.ones(n_rows, dtype=bool)
+    starts[1:] = (sorted_keys[1:] != sorted_keys[:-1]) | \
+        (sorted_lengths[1:] != sorted_lengths[:-1])
+    leader = numpy.empty(n_rows, dtype=numpy.intp)
+    leader[order] = order[starts][numpy.cumsum(starts) - 1]
+
+    check = numpy.flatnonzero(leader != numpy.arange(n_rows))
+    collided = check[_rows_differ(indptr, indices, check, leader[check])]
+    leader[collided] = collided
+
+    is_first = leader == numpy.arange(n_rows)
+    first = numpy.flatnonzero(is_first)
+    inverse = (numpy.cumsum(is_first) - 1)[leader]
+    counts = numpy.bincount(inverse, minlength=len(first))
+    return first, inverse, counts
+
+
+def class_replicas(counts, max_copies):
+    """
+    Represent classes of identical items by up to 'max_copies' rows each.
+
+    Returns (rows, first_copy): the class of each replica row, and the
+    first replica row of each class.
+    """
+    copies = numpy.minimum(counts, max_copies)
+    rows = numpy.repeat(numpy.arange(len(counts)), copies)
+    first_copy = numpy.cumsum(copies) - copies
+    return rows, first_copy
+
+
+def pack_presence_csr(indptr, indices, n_samples):
+    """
+    Pack CSR presence rows into rows of uint64 bits.
+
+    Returns a (len(indptr) - 1) x ceil(n_samples / 64) uint64 array, where
+    bit k of word w in row i is set if sample 64*w + k is in row i.
+    """
+    n_rows = len(indptr) - 1
+    rows = numpy.repeat(numpy.arange(n_rows), numpy.diff(indptr))
+    cols = numpy.asarray(indices, dtype=numpy.intp)
+
+    n_words = max(1, (n_samples + 63) // 64)
+    packed = numpy.zeros((n_rows, n_words), dtype='<u8')
+    bits = numpy.left_shift(numpy.uint64(1), (cols & 63).astype(numpy.uint64))
+    numpy.bitwise_or.at(packed, (rows, cols >> 6), bits)
+
+    return packed
+
+
+PRESENCE_MATRIX_FORMATS = ('float', 'uint8', 'bool', 'packed', 'csr', 'csc')
+
+
+def presence_matrix_from_csr(indptr, indices, n_samples, *, format='float'):
+    """
+    Build a sample x hash presence matrix from CSR presence rows (one row
+    of sample indices per hash).
+
+    'format' is one of PRESENCE_MATRIX_FORMATS: a dense float64, uint8 or
+    bool array; 'packed', a uint8 array with the hash axis packed 8 hashes
+    per byte (recover row s with numpy.unpackbits(m[s], count=n_hashes,
+    bitorder='little')); or a scipy.sparse CSR/CSC matrix of uint8 ones.
+    """
+    if format not in PRESENCE_MATRIX_FORMATS:
+        raise ValueError(f"unknown presence matrix format '{format}'; must be one of {', '.join(PRESENCE_MATRIX_FORMATS)}")
+
+    n_hashes = len(indptr) - 1
+    rows = numpy.asarray(indices, dtype=numpy.intp)
+    cols = numpy.repeat(numpy.arange(n_hashes), numpy.diff(indptr))
+
+    if format in ('csr', 'csc'):
+        # hash-major CSR presence rows are already the sample x hash CSC
+        # matrix, up to the order of the rows within each column.
+        mat = scipy.sparse.csc_matrix(
+            (numpy.ones(len(rows), dtype=numpy.uint8), rows,
+             numpy.asarray(indptr)), shape=(n_samples, n_hashes))
+        mat.sort_indices()
+        return mat.tocsr() if format == 'csr' else mat
+
+    if format == 'packed':
+        mat = numpy.zeros((n_samples, (n_hashes + 7) // 8), dtype=numpy.uint8)
+        bits = numpy.left_shift(numpy.uint8(1), (cols & 7).astype(numpy.uint8))
+        numpy.bitwise_or.at(mat, (rows, cols >> 3), bits)
+        return mat
+
+    dtype = { 'float': numpy.float64, 'uint8': numpy.uint8, 'bool': bool }[format]
+    mat = numpy.zeros((n_samples, n_hashes), dtype=dtype)
+    mat[rows, cols] = 1
+    return mat
+
+
+def plot_order(labels):
+    """
+    Order items by cluster label, keeping the original order within each
+    cluster and putting unclustered (negative label) items last.
+    """
+    labels = numpy.asarray(labels)
+    if not len(labels):
+        return numpy.zeros(0, dtype=numpy.intp)
+    key = numpy.where(labels < 0, labels.max() + 1, labels)
+    return numpy.argsort(key, kind='stable')
+
+
+def block_starts(n, n_blocks):
+    """
+    Split n consecutive positions into n_blocks nearly equal blocks; position
+    p falls in block p * n_blocks // n. Returns the first position of each
+    block.
+    """
+    return -(-numpy.arange(n_blocks) * n // n_blocks)
+
+
+def block_average(matrix, row_order, col_order, *, shape, chunk_size=2**24):
+    """
+    Average 'matrix' down to at most 'shape' = (n_rows, n_cols) blocks, after
+    ordering its rows by 'row_order' and columns by 'col_order'; see
+    block_starts.
+
+    'matrix' may be a dense array (read in strips of about 'chunk_size'
+    cells, so memmaps are fine) or a scipy.sparse matrix. Returns a float32
+    array.
+    """
+    n_rows, n_cols = len(row_order), len(col_order)
+    out_rows, out_cols = min(shape[0], n_rows), min(shape[1], n_cols)
+
+    # map original row/column indices => block
+    row_block = numpy.empty(n_rows, dtype=numpy.intp)
+    row_block[row_order] = numpy.arange(n_rows) * out_rows // n_rows
+    col_block = numpy.empty(n_cols, dtype=numpy.intp)
+    col_block[col_order] = numpy.arange(n_cols) * out_cols // n_cols
+
+    if scipy.sparse.issparse(matrix):
+        coo = matrix.tocoo()
+        flat = row_block[coo.row] * out_cols + col_block[coo.col]
+        sums = numpy.bincount(flat, weights=coo.data,
+                              minlength=out_rows * out_cols)
+        sums = sums.reshape(out_rows, out_cols)
+    else:
+        sums = numpy.zeros((out_rows, out_cols))
+        col_starts = block_starts(n_cols, out_cols)
+        strip = max(1, chunk_size // max(n_cols, 1))
+        for start in range(0, n_rows, strip):
+            rows = numpy.asarray(matrix[start:start + strip], dtype=numpy.float64)
+            col_sums = numpy.add.reduceat(rows[:, col_order], col_starts,
+                                          axis=1)
+            numpy.add.at(sums, row_block[start:start + len(rows)], col_sums)
+
+    counts = numpy.outer(numpy.bincount(row_block, minlength=out_rows),
+                         numpy.bincount(col_block, minlength=out_cols))
+    return (sums / counts).astype(numpy.float32)
+
+
+def expand_matrix(matrix, rows, cols=None, *, out=None, chunk_size=2**24):
+    """
+    Return matrix[rows][:, cols] (with cols defaulting to rows), e.g. to
+    expand a matrix over classes of identical presence vectors back to
+    one row and column per hash.
+
+    A dense result is built in strips of about 'chunk_size' cells, and
+    written into 'out' (e.g. a memmap) if given. A sparse matrix gives a
+    sparse CSR result.
+    """
+    if cols is None:
+        cols = rows
+    if scipy.sparse.issparse(matrix):
+        return matrix.tocsr()[rows][:, cols]
+
+    if out is None:
+        out = numpy.empty((len(rows), len(cols)), dtype=matrix.dtype)
+    strip = max(1, chunk_size // max(len(cols), 1))
+    for start in range(0, len(rows), strip):
+        out[start:start + strip] = matrix[rows[start:start + strip]][:, cols]
+    return out
+
+
+def _unpack_rows(packed, n_samples):
+    "Expand bit-packed presence rows into a float32 0/1 matrix."
+    bits = numpy.unpackbits(packed.view(numpy.uint8), axis=1,
+                            count=n_samples, bitorder='little')
+    return bits.astype(numpy.float32)
+
+
+def popcount_rows(packed):
+    "Count the set bits in each row of a bit-packed presence matrix."
+    if hasattr(numpy, 'bitwise_count'):
+        return numpy.bitwise_count(packed).sum(axis=1, dtype=numpy.int64)
+    bits = numpy.unpackbits(packed.view(numpy.uint8), axis=1)
+    return bits.sum(axis=1, dtype=numpy.int64)
+
+
+def iter_jaccard_tiles(packed, *, n_samples=None,
+                       block_size=DEFAULT_BLOCK_SIZE, lower_only=True,
+                       i_starts=None, counts=None):
+    """
+    Compute the Jaccard similarity of bit-packed presence rows, tile by tile.
+
+    Yields (i_start, j_start, tile) where 'tile' holds the similarities of
+    rows i_start:i_start+len(tile) against rows j_start:j_start+tile.shape[1].
+    Intersection counts are computed as a matrix multiply of the unpacked
+    rows. If 'lower_only', only tiles on or below the diagonal are yielded.
+    'i_starts' restricts the computation to the row strips starting at
+    those rows (multiples of block_size). 'counts' may pass in
+    precomputed popcount_rows(packed).
+    """
+    n_rows = packed.shape[0]
+    if n_samples is None:
+        n_samples = packed.shape[1] * 64
+    if i_starts is None:
+        i_starts = range(0, n_rows, block_size)
+    if counts is None:
+        counts = popcount_rows(packed)
+    counts = counts.astype(numpy.float64)
+
+    for i_start in i_starts:
+        i_end = min(i_start + block_size, n_rows)
+        block_i = _unpack_rows(packed[i_start:i_end], n_samples)
+
+        j_stop = i_end if lower_only else n_rows
+        for j_start in range(0, j_stop, block_size):
+            j_end = min(j_start + block_size, n_rows)
+            if j_start == i_start:
+                block_j = block_i
+            else:
+                block_j = _unpack_rows(packed[j_start:j_end], n_samples)
+
+            intersect = block_i @ block_j.T
+            union = counts[i_start:i_end, None] + counts[None, j_start:j_end] \
+                - intersect
+            tile = numpy.divide(intersect, union,
+                                out=numpy.zeros_like(union, dtype=float),
+                                where=union > 0)
+
+            yield i_start, j_start, tile
+
+
+def convert_jaccard(values, dtype):
+    "Convert Jaccard similarities to 'dtype', quantizing for uint16."
+    dtype = numpy.dtype(dtype)
+    if dtype == numpy.uint16:
+        return numpy.rint(values * JACCARD_UINT16_SCALE).astype(numpy.uint16)
+    return values.astype(dtype, copy=False)
+
+
+def open_association_memmap(filename, n_rows, *, dtype=float):
+    "Create an n_rows x n_rows '.npy' file, memory-mapped for writing."
+    return numpy.lib.format.open_memmap(filename, mode='w+',
+                                        dtype=numpy.dtype(dtype),
+                                        shape=(n_rows, n_rows))
+
+
+def _fill_association_strip(out, packed, i_start, *, n_samples, block_size,
+                            counts=None):
+    """
+    Compute the lower-triangle tiles of the row strip starting at 'i_start'
+    and write them, mirrored, into the square array 'out'. Returns the
+    number of tiles computed.
+    """
+    n_tiles = 0
+    tiles = iter_jaccard_tiles(packed, n_samples=n_samples,
+                               block_size=block_size, i_starts=[i_start],
+                               counts=counts)
+    for _, j_start, tile in tiles:
+        if j_start == i_start:
+            numpy.fill_diagonal(tile, 1)
+        tile = convert_jaccard(tile, out.dtype)
+        i_end = i_start + tile.shape[0]
+        j_end = j_start + tile.shape[1]
+        out[i_start:i_end, j_start:j_end] = tile
+        out[j_start:j_end, i_start:i_end] = tile.T
+        n_tiles += 1
+
+    return n_tiles
+
+
+#
+# parallel association computation: the packed presence rows (and, for
+# in-memory output, the output matrix) are placed in shared memory, and
+# worker processes compute row strips of the lower triangle, writing them
+# straight into the output. Memory-mapped outputs are opened by filename
+# in each worker.
+#
+
+# per-worker state, set by _init_association_worker.
+_assoc_state = {}
+
+
+def _create_shared_array(shape, dtype):
+    "Create a numpy array backed by a new SharedMemory block."
+    dtype = numpy.dtype(dtype)
+    size = max(int(numpy.prod(shape)) * dtype.itemsize, 1)
+    shm = shared_memory.SharedMemory(create=True, size=size)
+    arr = numpy.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    return shm, arr, (shm.name, shape, dtype.str)
+
+
+def _attach_shared_array(spec):
+    "Attach to a SharedMemory-backed array created by _create_shared_array."
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, numpy.ndarray(shape, dtype=numpy.dtype(dtype), buffer=shm.buf)
+
+
+def _create_shared_result(shape, dtype):
+    """
+    Create a numpy array backed by a new SharedMemory block, which is
+    closed once the array is freed. Returns (shm, arr, spec); the caller
+    unlinks 'shm' once the workers are done with it.
+    """
+    shm, arr, spec = _create_shared_array(shape, dtype)
+    weakref.finalize(arr, shm.close)
+    return shm, arr, spec
+
+
+def _memmap_spec(arr):
+    """
+    Return (filename, dtype, offset, shape) for reopening the memmap 'arr'
+    in another process, or None if 'arr' is not a whole, C-ordered mapping
+    of a file.
+    """
+    if not isinstance(arr, numpy.memmap) or arr.filename is None:
+        return None
+    if not isinstance(arr.base, mmap.mmap) or not arr.flags.c_contiguous:
+        return None
+    return (arr.filename, arr.dtype.str, arr.offset, arr.shape)
+
+
+def _init_association_worker(packed_spec, counts, out_spec, out_file,
+                             n_samples, block_size):
+    shm, packed = _attach_shared_array(packed_spec)
+    _assoc_state.update(packed_shm=shm, packed=packed, counts=counts,
+                        out_file=out_file, n_samples=n_samples,
+                        block_size=block_size)
+    if out_spec is not None:
+        out_shm, out = _attach_shared_array(out_spec)
+        _assoc_state.update(out_shm=out_shm, out=out)
+
+
+def _association_strip_task(i_start):
+    "Compute one row strip of the association matrix (in a worker)."
+    state = _assoc_state
+    if state['out_file'] is not None:
+        filename, dtype, offset, shape = state['out_file']
+        out = numpy.memmap(filename, dtype=numpy.dtype(dtype), mode='r+',
+                           offset=offset, shape=shape)
+    else:
+        out = state['out']
+
+    n_tiles = _fill_association_strip(out, state['packed'], i_start,
+                                      n_samples=state['n_samples'],
+                                      block_size=state['block_size'],
+                                      counts=state['counts'])
+    if isinstance(out, numpy.memmap):
+        out.flush()
+    return i_start, n_tiles
+
+
+def _iter_parallel_strips(packed, strips, *, n_samples, block_size, cores,
+                          out_file=None, out_shm=None, out_spec=None):
+    """
+    Compute the given row strips in a pool of 'cores' processes, writing
+    into the file mapping 'out_file' (see _memmap_spec) or the shared
+    array 'out_spec' (see _create_shared_result), whose block 'out_shm'
+    is unlinked when done. Yields (i_start, n_tiles) as each strip is
+    finished.
+    """
+    packed_shm, shared_packed, packed_spec = \
+        _create_shared_array(packed.shape, packed.dtype)
+    shared_packed[...] = packed
+    counts = popcount_rows(packed)
+
+    # biggest strips (furthest down the triangle) first, for load balance.
+    strips = sorted(strips, reverse=True)
+    try:
+        initargs = (packed_spec, counts, out_spec, out_file, n_samples,
+                    block_size)
+        with multiprocessing.Pool(cores, initializer=_init_association_worker,
+                                  initargs=initargs) as pool:
+            yield from pool.imap_unordered(_association_strip_task, strips)
+    finally:
+        del shared_packed
+        packed_shm.close()
+        packed_shm.unlink()
+        if out_shm is not None:
+            out_shm.unlink()
+
+
+def jaccard_from_packed(packed, *, n_samples=None,
+                        block_size=DEFAULT_BLOCK_SIZE, dtype=float, out=None,
+                        cores=1):
+    """
+    Compute the all-by-all Jaccard similarity of bit-packed presence rows.
+
+    Only tiles on or below the diagonal are computed, and mirrored into
+    the upper triangle. The result is written into 'out' if given, and
+    otherwise into a new array of type 'dtype' (see convert_jaccard).
+
+    With cores > 1, row strips are computed by a pool of processes that
+    write directly into 'out' if it is a memmap, and otherwise into a new
+    shared memory array, which is returned (or, for an in-memory 'out',
+    copied into it).
+    """
+    n_rows = packed.shape[0]
+    if n_samples is None:
+        n_samples = packed.shape[1] * 64
+    if out is not None:
+        assert out.shape == (n_rows, n_rows)
+
+    strips = range(0, n_rows, block_size)
+    if cores > 1:
+        out_file = _memmap_spec(out) if out is not None else None
+        out_shm = None
+        out_spec = None
+        result = out
+        if out_file is None:
+            out_dtype = out.dtype if out is not None else dtype
+            out_shm, result, out_spec = _create_shared_result((n_rows, n_rows),
+                                                              out_dtype)
+        for _ in _iter_parallel_strips(packed, strips, n_samples=n_samples,
+                                       block_size=block_size, cores=cores,
+                                       out_file=out_file, out_shm=out_shm,
+                                       out_spec=out_spec):
+            pass
+
+        if out is not None and result is not out:
+            out[...] = result
+            return out
+        return result
+
+    if out is None:
+        out = numpy.zeros((n_rows, n_rows), dtype=dtype)
+    counts = popcount_rows(packed)
+    for i_start in strips:
+        _fill_association_strip(out, packed, i_start, n_samples=n_samples,
+                                block_size=block_size, counts=counts)
+
+    return out
+
+
+def block_size_for_memory(n_rows, n_samples, memory_budget, *, itemsize=8):
+    """
+    Pick the largest tile size for write_association_file whose working
+    memory (packed rows, tile arrays, and mapped output pages) fits
+    in 'memory_budget' bytes.
+    """
+    fixed = n_rows * max(1, (n_samples + 63) // 64) * 8 + n_rows * 8
+
+    def cost(b):
+        tiles = 32 * b * b + 8 * b * n_samples
+        mapped = b * n_rows * itemsize + n_rows * max(mmap.PAGESIZE, b * itemsize)
+        return fixed + tiles + mapped
+
+    if cost(1) > memory_budget:
+        raise ValueError(f"memory budget of {memory_budget} bytes is too small for {n_rows} hashes x {n_samples} samples")
+
+    lo, hi = 1, max(n_rows, 1)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if cost(mid) <= memory_budget:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def write_association_file(filename, packed, *, n_samples=None, dtype=float,
+                           block_size=DEFAULT_BLOCK_SIZE, fingerprint=None,
+                           cores=1):
+    """
+    Compute the all-by-all Jaccard similarity of bit-packed presence rows
+    into the '.npy' file 'filename', one row strip at a time.
+
+    Only tiles on or below the diagonal are computed, and mirrored. The
+    output is memory-mapped only while each strip is written, so memory
+    use is bounded by the tile size rather than by the matrix size.
+    Completed strips are recorded in '<filename>.progress'; if that file
+    matches these parameters (including the presence data 'fingerprint'),
+    the computation resumes where it left off. With cores > 1, strips
+    are computed by a pool of processes writing into the file directly.
+    """
+    n_rows = packed.shape[0]
+    if n_samples is None:
+        n_samples = packed.shape[1] * 64
+    dtype = numpy.dtype(dtype)
+    progress_file = filename + '.progress'
+    params = dict(n_rows=n_rows, dtype=dtype.str, block_size=block_size,
+                  fingerprint=fingerprint)
+    all_strips = list(range(0, n_rows, block_size))
+
+    done = set()
+    if os.path.exists(progress_file) and os.path.exists(filename):
+        with open(progress_file) as fp:
+            state = json.load(fp)
+        if state['params'] == params:
+            done = set(state['done'])
+            print(f"resuming '{filename}': {len(done)} of {len(all_strips)} row strips already computed.")
+    if not done:
+        out = open_association_memmap(filename, n_rows, dtype=dtype)
+        del out
+
+    strips = [ i for i in all_strips if i not in done ]
+    n_tiles = sum(i // block_size + 1 for i in strips)
+    progress = ProgressBar(n_tiles, desc='association matrix', unit='tiles')
+
+    if cores > 1:
+        out = numpy.lib.format.open_memmap(filename, mode='r')
+        out_file = _memmap_spec(out)
+        del out
+        finished = _iter_parallel_strips(packed, strips, n_samples=n_samples,
+                                         block_size=block_size, cores=cores,
+                                         out_file=out_file)
+    else:
+        finished = _iter_serial_file_strips(filename, packed, strips,
+                                            n_samples=n_samples,
+                                            block_size=block_size)
+
+    for i_start, strip_tiles in finished:
+        done.add(i_start)
+        tmp_progress = progress_file + '.tmp'
+        with open(tmp_progress, 'w') as fp:
+            json.dump(dict(params=params, done=sorted(done)), fp)
+        os.replace(tmp_progress, progress_file)
+        progress.update(strip_tiles)
+    progress.close()
+
+    if os.path.exists(progress_file):
+        os.remove(progress_file)
+
+
+def _iter_serial_file_strips(filename, packed, strips, *, n_samples,
+                             block_size):
+    "Compute row strips into the .npy file 'filename' in this process."
+    counts = popcount_rows(packed)
+    for i_start in strips:
+        out = numpy.lib.format.open_memmap(filename, mode='r+')
+        n_tiles = _fill_association_strip(out, packed, i_start,
+                                          n_samples=n_samples,
+                                          block_size=block_size,
+                                          counts=counts)
+        out.flush()
+        del out
+        yield i_start, n_tiles
+
+
+def sparse_jaccard_from_packed(packed, *, n_samples=None, threshold=None,
+                               top_k=None, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Compute a sparse, symmetric Jaccard similarity matrix of bit-packed
+    presence rows.
+
+    Pairs with similarity >= 'threshold' are kept, as are pairs where one
+    row is among the 'top_k' most similar rows of the other (even if their
+    similarity is 0); the diagonal is always 1. Returns a scipy.sparse CSR
+    matrix, with explicit zeros for kept pairs with no shared samples.
+    """
+    if threshold is None and top_k is None:
+        raise ValueError("must specify threshold and/or top_k")
+
+    n_rows = packed.shape[0]
+    if n_rows == 0:
+        empty = numpy.zeros(0, dtype=numpy.int64)
+        return _symmetric_similarity_csr(empty, empty, numpy.zeros(0), 0)
+
+    rows = []
+    cols = []
+    vals = []
+
+    if top_k is None:
+        # keep pairs over threshold from the lower triangle, then mirror.
+        for i_start, j_start, tile in iter_jaccard_tiles(packed,
+                                                         n_samples=n_samples,
+                                                         block_size=block_size):
+            keep = tile >= threshold
+            if i_start == j_start:
+                keep &= numpy.tri(*tile.shape, k=-1, dtype=bool)
+            r, c = numpy.nonzero(keep)
+            rows.append(r + i_start)
+            cols.append(c + j_start)
+            vals.append(tile[r, c])
+    else:
+        # keep the top_k entries of each row, across full row strips, plus
+        # any entries over threshold.
+        cand_cols = []
+        cand_vals = []
+        for i_start, j_start, tile in iter_jaccard_tiles(packed,
+                                                         n_samples=n_samples,
+                                                         block_size=block_size,
+                                                         lower_only=False):
+            i_end = i_start + tile.shape[0]
+            j_end = j_start + tile.shape[1]
+
+            # exclude self-pairs
+            diag = numpy.arange(max(i_start, j_start), min(i_end, j_end))
+            tile[diag - i_start, diag - j_start] = -1
+
+            if threshold is not None:
+                r, c = numpy.nonzero(tile >= threshold)
+                rows.append(r + i_start)
+                cols.append(c + j_start)
+                vals.append(tile[r, c])
+
+            k = min(top_k, tile.shape[1])
+            idx = numpy.argpartition(-tile, k - 1, axis=1)[:, :k]
+            cand_cols.append(idx + j_start)
+            cand_vals.append(numpy.take_along_axis(tile, idx, axis=1))
+
+            if j_end < n_rows:
+                continue
+
+            # end of this row strip: pick the top_k across all tiles.
+            cand_cols = numpy.hstack(cand_cols)
+            cand_vals = numpy.hstack(cand_vals)
+            k = min(top_k, n_rows - 1)
+            idx = numpy.argpartition(-cand_vals, k - 1, axis=1)[:, :k]
+            c = numpy.take_along_axis(cand_cols, idx, axis=1).ravel()
+            v = numpy.take_along_axis(cand_vals, idx, axis=1).ravel()
+            r = numpy.repeat(numpy.arange(i_start, i_end), k)
+            cand_cols = []
+            cand_vals = []
+
+            # skip entries already kept by threshold
+            keep = v >= 0
+            if threshold is not None:
+                keep &= v < threshold
+            rows.append(r[keep])
+            cols.append(c[keep])
+            vals.append(v[keep])
+
+    return _symmetric_similarity_csr(numpy.concatenate(rows),
+                                     numpy.concatenate(cols),
+                                     numpy.concatenate(vals), n_rows)
+
+
+def _symmetric_similarity_csr(rows, cols, vals, n_rows):
+    """
+    Build a symmetric CSR similarity matrix from (rows, cols, vals) entries
+    in either triangle, with 1 on the diagonal. Each pair keeps its
+    maximum value, and zero values are kept as explicit entries.
+    """
+    diag = numpy.arange(n_rows)
+    rows, cols = (numpy.concatenate([rows, cols, diag]),
+                  numpy.concatenate([cols, rows, diag]))
+    vals = numpy.concatenate([vals, vals, numpy.ones(n_rows)])
+
+    # keep one (maximum) value per pair.
+    order = numpy.lexsort((-vals, cols, rows))
+    rows, cols, vals = rows[order], cols[order], vals[order]
+    first = numpy.ones(len(rows), dtype=bool)
+    first[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+
+    return scipy.sparse.csr_matrix((vals[first], (rows[first], cols[first])),
+                                   shape=(n_rows, n_rows))
+
+
+#
+# approximate nearest neighbors: MinHash signatures of each hash's set of
+# samples are split into bands, and hashes that agree on a whole band (an
+# LSH bucket) are candidate neighbors. Exact Jaccard similarities are then
+# computed from the packed rows for the candidate pairs only.
+#
+
+def minhash_signatures(indptr, indices, n_samples, n_hashes, *, seed=1):
+    """
+    Compute MinHash signatures of CSR presence rows: value h of row i is
+    the minimum, over the samples in row i, of a random permutation h of
+    the sample indices. Returns a (n_rows, n_hashes) uint32 array.
+    """
+    rng = numpy.random.default_rng(seed)
+    n_rows = len(indptr) - 1
+    starts = numpy.asarray(indptr[:-1])
+    nonempty = numpy.diff(indptr) > 0
+
+    sigs = numpy.full((n_rows, n_hashes), n_samples, dtype=numpy.uint32)
+    for h in range(n_hashes):
+        perm = rng.permutation(n_samples).astype(numpy.uint32)
+        if nonempty.any():
+            sigs[nonempty, h] = numpy.minimum.reduceat(perm[indices],
+                                                       starts[nonempty])
+    return sigs
+
+
+def one_permutation_signatures(indptr, indices, n_samples, n_bins, *,
+                               seed=1):
+    """
+    Compute one-permutation MinHash signatures of CSR presence rows: the
+    sample indices are permuted once and split into 'n_bins' ranges, and
+    value h of row i is the smallest permuted sample of row i in range h.
+    Empty bins are filled from the next non-empty bin (rotation
+    densification). Returns a (n_rows, n_bins) uint64 array.
+    """
+    rng = numpy.random.default_rng(seed)
+    n_rows = len(indptr) - 1
+    perm = rng.permutation(n_samples).astype(numpy.uint64)
+
+    vals = perm[indices]
+    bins = (vals * numpy.uint64(n_bins) // numpy.uint64(n_samples)).astype(numpy.intp)
+    rows = numpy.repeat(numpy.arange(n_rows), numpy.diff(indptr))
+    empty = numpy.uint64(2**64 - 1)
+    sigs = numpy.full((n_rows, n_bins), empty, dtype=numpy.uint64)
+    numpy.minimum.at(sigs, (rows, bins), vals)
+
+    # for each bin, find the next non-empty bin, wrapping around.
+    filled = numpy.hstack([sigs, sigs]) != empty
+    pos = numpy.where(filled, numpy.arange(2 * n_bins), 2 * n_bins)
+    next_filled = numpy.minimum.accumulate(pos[:, ::-1], axis=1)[:, ::-1]
+    next_filled = next_filled[:, :n_bins]
+
+    has_any = next_filled[:, 0] < 2 * n_bins
+    dist = (next_filled - numpy.arange(n_bins))[has_any]
+    src = numpy.take_along_axis(sigs[has_any], next_filled[has_any] % n_bins,
+                                axis=1)
+    # offset borrowed values by the distance, so they only match values
+    # borrowed from the same distance.
+    sigs[has_any] = src + dist.astype(numpy.uint64) * numpy.uint64(n_samples)
+    return sigs
+
+
+def lsh_parameters(threshold, recall, *, max_hashes=256):
+    """
+    Choose LSH banding (bands, rows) so that pairs with Jaccard similarity
+    'threshold' share a bucket with probability at least 'recall', using
+    at most 'max_hashes' signature values. Of the choices that meet this,
+    the one with the most rows per band is used, as it produces the fewest
+    candidates below the threshold.
+    """
+    if not 0 < threshold <= 1 or not 0 < recall < 1:
+        raise ValueError("threshold must be in (0, 1], and recall in (0, 1)")
+
+    best = None
+    for rows in range(1, max_hashes + 1):
+        p = threshold ** rows
+        if p >= 1:
+            bands = 1
+        elif p <= 0:
+            break
+        else:
+            bands = math.ceil(math.log(1 - recall) / math.log1p(-p))
+        if bands * rows <= max_hashes:
+            best = (bands, rows)
+
+    if best is None:
+        raise ValueError(f"cannot reach recall {recall} at threshold {threshold} with {max_hashes} hashes")
+    return best
+
+
+def lsh_recall(similarity, bands, rows):
+    "The probability that a pair with this Jaccard similarity is a candidate."
+    return 1 - (1 - similarity ** rows) ** bands
+
+
+def lsh_candidate_pairs(signatures, *, bands, rows, max_neighbors=None,
+                        seed=1):
+    """
+    Find candidate pairs of rows whose signatures agree on all 'rows'
+    values of at least one of 'bands' bands. If 'max_neighbors' is set,
+    rows in each bucket are put in a random order and paired with the
+    next 'max_neighbors' rows only, bounding the work for large buckets;
+    otherwise all pairs in each bucket are candidates.
+
+    Returns unique (i, j) index arrays, with i < j.
+    """
+    rng = numpy.random.default_rng(seed)
+    n_rows = signatures.shape[0]
+    pair_keys = numpy.zeros(0, dtype=numpy.int64)
+    new_keys = []
+    n_new = 0
+    for b in range(bands):
+        key = numpy.zeros(n_rows, dtype=numpy.uint64)
+        for col in signatures[:, b * rows:(b + 1) * rows].T:
+            key = key * numpy.uint64(1000003) + col
+
+        order = numpy.lexsort((rng.permutation(n_rows), key))
+        key = key[order]
+
+        # pair each row with the rows after it in the same bucket.
+        bucket_start = numpy.flatnonzero(numpy.r_[True, key[1:] != key[:-1]])
+        sizes = numpy.diff(numpy.r_[bucket_start, n_rows])
+        bucket_end = numpy.repeat(bucket_start + sizes, sizes)
+        n_partners = bucket_end - numpy.arange(n_rows) - 1
+        if max_neighbors is not None:
+            n_partners = numpy.minimum(n_partners, max_neighbors)
+
+        first = numpy.repeat(numpy.arange(n_rows), n_partners)
+        offset = numpy.arange(len(first)) - \
+            numpy.repeat(numpy.cumsum(n_partners) - n_partners, n_partners)
+        i = order[first].astype(numpy.int64)
+        j = order[first + offset + 1].astype(numpy.int64)
+
+        new_keys.append(numpy.minimum(i, j) * n_rows + numpy.maximum(i, j))
+        n_new += len(i)
+
+        # merge in new pairs once they would double the memory used.
+        if n_new > len(pair_keys) or b == bands - 1:
+            pair_keys = _sorted_unique(numpy.concatenate([pair_keys] + new_keys))
+            new_keys = []
+            n_new = 0
+
+    return pair_keys // n_rows, pair_keys % n_rows
+
+
+def _sorted_unique(arr):
+    """
+    numpy.unique for a large 1-d integer array. Recent numpy uses a much
+    slower hash table for plain unique() on integers; sorting is faster.
+    """
+    arr = numpy.sort(arr)
+    if not len(arr):
+        return arr
+    return arr[numpy.r_[True, arr[1:] != arr[:-1]]]
+
+
+def jaccard_pairs_from_packed(packed, i, j, *, counts=None,
+                              chunk_size=1_000_000):
+    "Compute the Jaccard similarity of bit-packed rows i[n] and j[n]."
+    if counts is None:
+        counts = popcount_rows(packed)
+
+    sim = numpy.zeros(len(i), dtype=numpy.float64)
+    for start in range(0, len(i), chunk_size):
+        ci = i[start:start + chunk_size]
+        cj = j[start:start + chunk_size]
+        inter = popcount_rows(packed[ci] & packed[cj])
+        union = counts[ci] + counts[cj] - inter
+        sim[start:start + chunk_size] = numpy.divide(inter, union,
+                                                     out=numpy.zeros(len(ci)),
+                                                     where=union > 0)
+    return sim
+
+
+def knn_jaccard_graph(packed, indptr, indices, *, n_samples, k,
+                      bands=DEFAULT_LSH_BANDS, rows=DEFAULT_LSH_ROWS, seed=1):
+    """
+    Build an approximate k-nearest-neighbor graph of presence rows by
+    Jaccard similarity, without computing all pairs.
+
+    Candidates come from MinHash LSH (see lsh_candidate_pairs), plus
+    rows i+1..i+k for each row i so that every row has at least k
+    candidates. Each row keeps its k most similar candidates. Returns a
+    sparse symmetric similarity matrix like sparse_jaccard_from_packed,
+    with explicit zeros for neighbors with no shared samples.
+    """
+    n_rows = packed.shape[0]
+    k = min(k, n_rows - 1)
+    if k < 1:
+        empty = numpy.zeros(0, dtype=numpy.int64)
+        return _symmetric_similarity_csr(empty, empty,
+                                         numpy.zeros(0), n_rows)
+
+    sigs = minhash_signatures(indptr, indices, n_samples, bands * rows,
+                              seed=seed)
+    i, j = lsh_candidate_pairs(sigs, bands=bands, rows=rows, max_neighbors=k,
+                               seed=seed)
+
+    pad_i = numpy.repeat(numpy.arange(n_rows), k)
+    pad_j = (pad_i + numpy.tile(numpy.arange(1, k + 1), n_rows)) % n_rows
+    i = numpy.concatenate([i, pad_i])
+    j = numpy.concatenate([j, pad_j])
+    pair_key = _sorted_unique(numpy.minimum(i, j) * n_rows + numpy.maximum(i, j))
+    i, j = pair_key // n_rows, pair_key % n_rows
+    print(f"computing Jaccard similarity for {len(i)} candidate pairs ({len(i) / max(n_rows * (n_rows - 1) / 2, 1):.2%} of all pairs).")
+
+    sim = jaccard_pairs_from_packed(packed, i, j)
+
+    # keep the k most similar candidates of each row.
+    r = numpy.concatenate([i, j])
+    c = numpy.concatenate([j, i])
+    v = numpy.concatenate([sim, sim])
+    order = numpy.lexsort((-v, r))
+    r, c, v = r[order], c[order], v[order]
+    row_start = numpy.searchsorted(r, numpy.arange(n_rows))
+    rank = numpy.arange(len(r)) - row_start[r]
+    keep = rank < k
+
+    return _symmetric_similarity_csr(r[keep], c[keep], v[keep], n_rows)
+
+
+def lsh_jaccard_matrix(packed, indptr, indices, *, n_samples, threshold,
+                       recall=0.95, max_hashes=256, signature=None, seed=1):
+    """
+    Approximate sparse_jaccard_from_packed(threshold=threshold) without
+    computing all pairs: candidate pairs come from MinHash LSH, banded by
+    lsh_parameters(threshold, recall), and only candidates have their
+    exact Jaccard similarity computed.
+
+    All similarities returned are exact; the approximation is in the pairs
+    that are missed. Each pair with similarity s >= threshold is found with
+    probability at least lsh_recall(s, bands, rows) >= 'recall'.
+    'signature' is 'oph' for one-permutation MinHash, or 'minhash' for
+    one permutation per signature value. One-permutation MinHash is
+    cheaper, but only accurate for sets large enough to fill most of its
+    bins, so by default it is only used if most hashes are in at least
+    as many samples as there are signature values.
+
+    Returns (matrix, (bands, rows, signature)).
+    """
+    n_rows = packed.shape[0]
+    bands, rows = lsh_parameters(threshold, recall, max_hashes=max_hashes)
+
+    if signature is None:
+        median_samples = numpy.median(numpy.diff(indptr)) if n_rows else 0
+        signature = 'oph' if median_samples >= bands * rows else 'minhash'
+    if signature == 'oph':
+        sigs = one_permutation_signatures(indptr, indices, n_samples,
+                                          bands * rows, seed=seed)
+    elif signature == 'minhash':
+        sigs = minhash_signatures(indptr, indices, n_samples, bands * rows,
+                                  seed=seed)
+    else:
+        raise ValueError(f"unknown signature type '{signature}'")
+
+    i, j = lsh_candidate_pairs(sigs, bands=bands, rows=rows, seed=seed)
+    print(f"computing Jaccard similarity for {len(i)} candidate pairs ({len(i) / max(n_rows * (n_rows - 1) / 2, 1):.2%} of all pairs).")
+
+    sim = jaccard_pairs_from_packed(packed, i, j)
+    keep = sim >= threshold
+    matrix = _symmetric_similarity_csr(i[keep], j[keep], sim[keep], n_rows)
+    return matrix, (bands, rows, signature)
+
+
+def association_recall(approx, exact, *, bins=(0.5, 0.6, 0.7, 0.8, 0.9, 1.0)):
+    """
+    Compare an approximate sparse association matrix to the exact one.
+    For each similarity range [bins[n], bins[n+1]), plus [bins[-1], 1],
+    returns (low, high, number of exact pairs, number found in 'approx').
+    """
+    n_rows = exact.shape[0]
+    exact = scipy.sparse.triu(exact, k=1).tocoo()
+    approx = scipy.sparse.triu(approx, k=1).tocoo()
+    exact_keys = exact.row.astype(numpy.int64) * n_rows + exact.col
+    approx_keys = _sorted_unique(approx.row.astype(numpy.int64) * n_rows +
+                                 approx.col)
+
+    pos = numpy.searchsorted(approx_keys, exact_keys)
+    pos = numpy.minimum(pos, max(len(approx_keys) - 1, 0))
+    found = numpy.zeros(len(exact_keys), dtype=bool)
+    if len(approx_keys):
+        found = approx_keys[pos] == exact_keys
+
+    edges = list(bins)
+    results = []
+    for n, low in enumerate(edges):
+        high = edges[n + 1] if n + 1 < len(edges) else 1.0
+        if n + 1 < len(edges):
+            in_bin = (exact.data >= low) & (exact.data < high)
+        else:
+            in_bin = exact.data >= low
+        results.append((low, high, int(in_bin.sum()), int(found[in_bin].sum())))
+    return results
+
+
+def leiden_clusters(cmp, *, min_cluster_size, resolution=1.0, seed=1):
+    """
+    Cluster a sparse similarity graph with the Leiden algorithm, using
+    similarities as edge weights. Communities smaller than
+    'min_cluster_size' are labeled -1 (unclustered), as with HDBSCAN.
+
+    Requires the 'leidenalg' and 'igraph' packages.
+    """
+    try:
+        import igraph
+        import leidenalg
+    except ImportError:
+        raise ValueError("Leiden clustering requires the 'leidenalg' and 'igraph' packages")
+
+    edges = scipy.sparse.triu(cmp, k=1).tocoo()
+    keep = edges.data > 0
+    graph = igraph.Graph(n=cmp.shape[0],
+                         edges=numpy.column_stack([edges.row[keep],
+                                                   edges.col[keep]]).tolist(),
+                         edge_attrs=dict(weight=edges.data[keep].tolist()))
+    partition = leidenalg.find_partition(graph,
+                                         leidenalg.RBConfigurationVertexPartition,
+                                         weights='weight',
+                                         resolution_parameter=resolution,
+                                         seed=seed)
+
+    labels = numpy.array(partition.membership, dtype=numpy.int64)
+    sizes = numpy.bincount(labels)
+    labels[sizes[labels] < min_cluster_size] = -1
+    _, labels[labels >= 0] = numpy.unique(labels[labels >= 0],
+                                          return_inverse=True)
+    return labels
+
+
+def sparse_distance_graph(cmp, *, min_distance=1e-8):
+    """
+    Convert a sparse Jaccard similarity matrix into a sparse distance
+    graph suitable for HDBSCAN with metric='precomputed'.
+
+    Distances are 1 - similarity for each stored pair, floored at
+    'min_distance' so that identical presence vectors stay connected.
+    Disconnected components are joined by edges at the maximum Jaccard
+    distance of 1, so that HDBSCAN sees a single connected graph; this
+    only affects the top of the cluster hierarchy.
+    """
+    dist = cmp.tocsr(copy=True)
+    dist.data = numpy.maximum(1 - dist.data, min_distance)
+
+    n_components, labels = scipy.sparse.csgraph.connected_components(
+        dist, directed=False)
+    if n_components > 1:
+        # chain one representative of each component to the next.
+        reps = numpy.unique(labels, return_index=True)[1]
+        bridge = scipy.sparse.coo_matrix(
+            (numpy.ones(len(reps) - 1), (reps[:-1], reps[1:])),
+            shape=dist.shape)
+        dist = (dist + bridge + bridge.T).tocsr()
+
+    return dist
+
+
+#
+# HDBSCAN parameter sweeps: the data to cluster (a dense matrix, or the
+# arrays of a sparse distance graph) is placed in shared memory once, and
+# each setting is clustered in a worker process.
+#
+
+# per-worker state, set by _init_sweep_worker.
+_sweep_state = {}
+
+
+def _init_sweep_worker(specs, sparse_shape):
+    shms = []
+    arrays = []
+    for spec in specs:
+        shm, arr = _attach_shared_array(spec)
+        shms.append(shm)
+        arrays.append(arr)
+
+    if sparse_shape is not None:
+        data, indices, indptr = arrays
+        X = scipy.sparse.csr_matrix((data, indices, indptr), shape=sparse_shape)
+    else:
+        X, = arrays
+    _sweep_state.update(shms=shms, X=X)
+
+
+def _hdbscan_task(setting):
+    "Cluster the shared data with one (min_cluster_size, min_samples) setting."
+    import sklearn.cluster
+
+    X = _sweep_state['X']
+    min_cluster_size, min_samples = setting
+    if scipy.sparse.issparse(X):
+        # sklearn modifies precomputed sparse distances in place, so copy.
+        hdbscan = sklearn.cluster.HDBSCAN(min_cluster_size=min_cluster_size,
+                                          min_samples=min_samples,
+                                          metric='precomputed', copy=True)
+    else:
+        hdbscan = sklearn.cluster.HDBSCAN(min_cluster_size=min_cluster_size,
+                                          min_samples=min_samples, copy=False)
+    labels = hdbscan.fit_predict(X)
+    return setting, labels, hdbscan.probabilities_
+
+
+def hdbscan_sweep(X, settings, *, cores=1):
+    """
+    Run HDBSCAN on 'X' for each (min_cluster_size, min_samples) pair in
+    'settings', yielding (setting, labels, probabilities) in order.
+
+    A dense 'X' is clustered with the euclidean metric, and a sparse one
+    as a precomputed distance graph. With cores > 1, settings are
+    clustered in parallel by a pool of processes sharing 'X'.
+    """
+    settings = list(settings)
+    if scipy.sparse.issparse(X):
+        X = X.tocsr()
+        arrays = [X.data, X.indices, X.indptr]
+        sparse_shape = X.shape
+    else:
+        arrays = [numpy.asarray(X)]
+        sparse_shape = None
+
+    if cores <= 1 or len(settings) <= 1:
+        _sweep_state.update(X=X)
+        try:
+            yield from map(_hdbscan_task, settings)
+        finally:
+            # don't keep the distance matrix alive after the sweep.
+            _sweep_state.clear()
+        return
+
+    shms = []
+    specs = []
+    try:
+        for arr in arrays:
+            shm, shared, spec = _create_shared_array(arr.shape, arr.dtype)
+            shared[...] = arr
+            del shared
+            shms.append(shm)
+            specs.append(spec)
+
+        with multiprocessing.Pool(min(cores, len(settings)),
+                                  initializer=_init_sweep_worker,
+                                  initargs=(specs, sparse_shape)) as pool:
+            yield from pool.imap(_hdbscan_task, settings)
+    finally:
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+
+
+#
+# on-disk cache of association matrices, keyed by the presence data and the
+# matrix parameters, so that repeated clustering runs skip the matrix
+# computation.
+#
+
+class AssociationCache:
+    """
+    A directory of cached association matrices, with least-recently-used
+    eviction once the cached files exceed 'max_size' bytes.
+
+    Entries are keyed by HashPresenceInformation.fingerprint() (which
+    covers any filtering) plus the matrix parameters. Dense matrices are
+    stored as '.npy' files and returned memory-mapped; sparse matrices are
+    stored as scipy.sparse '.npz' files.
+    """
+    def __init__(self, cache_dir, *, max_size=None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, presence_info, suffix, **params):
+        key = dict(fingerprint=presence_info.fingerprint(), params=params)
+        digest = hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8'))
+        return os.path.join(self.cache_dir, digest.hexdigest() + suffix)
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.npy') or name.endswith('.npz'):
+                if '.partial' in name:
+                    continue
+                path = os.path.join(self.cache_dir, name)
+                st = os.stat(path)
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def _hit(self, path):
+        # record the use, for LRU eviction.
+        os.utime(path)
+        print(f"using cached association matrix '{path}'")
+
+    def evict(self, *, keep=None):
+        "Remove the least recently used entries (except 'keep') until under max_size."
+        if self.max_size is None:
+            return
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            if path == keep:
+                continue
+            print(f"evicting cached association matrix '{path}'")
+            os.remove(path)
+            total -= size
+
+    def association_matrix(self, presence_info, *, dtype=float, cores=1):
+        """
+        Return (hashvals, matrix) for the dense association matrix of
+        'presence_info', computing it into the cache if it isn't there.
+        """
+        dtype = numpy.dtype(dtype)
+        path = self._path(presence_info, '.npy', kind='dense',
+                          dtype=dtype.str)
+        if os.path.exists(path):
+            self._hit(path)
+        else:
+            partial = path[:-len('.npy')] + '.partial.npy'
+            presence_info.write_association_matrix(partial, dtype=dtype,
+                                                   cores=cores)
+            os.replace(partial, path)
+            self.evict(keep=path)
+
+        return presence_info.hashvals.tolist(), numpy.load(path, mmap_mode='r')
+
+    def sparse_association_matrix(self, presence_info, *, threshold=None,
+                                  top_k=None):
+        """
+        Return (hashvals, matrix) for the sparse association matrix of
+        'presence_info', computing it into the cache if it isn't there.
+        """
+        path = self._path(presence_info, '.npz', kind='sparse',
+                          threshold=threshold, top_k=top_k)
+        return self._sparse(path, presence_info,
+                            presence_info.build_sparse_association_matrix,
+                            threshold=threshold, top_k=top_k)
+
+    def knn_association_matrix(self, presence_info, *, k, **kwargs):
+        """
+        Return (hashvals, matrix) for the approximate kNN association graph
+        of 'presence_info', computing it into the cache if it isn't there.
+        """
+        path = self._path(presence_info, '.npz', kind='knn', k=k, **kwargs)
+        return self._sparse(path, presence_info,
+                            presence_info.build_knn_association_matrix,
+                            k=k, **kwargs)
+
+    def _sparse(self, path, presence_info, build, **kwargs):
+        if os.path.exists(path):
+            self._hit(path)
+            return presence_info.hashvals.tolist(), scipy.sparse.load_npz(path)
+
+        hashvals, cmp = build(**kwargs)
+        partial = path[:-len('.npz')] + '.partial.npz'
+        scipy.sparse.save_npz(partial, cmp)
+        os.replace(partial, path)
+        self.evict(keep=path)
+
+        return hashvals, cmp
+
+
+#
+# on-disk cache of downsampled sketch hashes, keyed by signature md5, ksize
+# and scaled, so that repeated scans of a sketch collection read
+# memory-mapped arrays instead of loading and downsampling each signature.
+# Entries are stored in segment files, each holding many sketches:
+#
+# 8 bytes     magic, b'HASHSEGM'
+# 8 bytes     little-endian uint64 length of JSON header
+# N bytes     JSON header: version, total number of hashes, and an index
+#             of {key: [offset, length]} for each sketch, in hashes
+# ...         <u8 sorted hashes of each sketch, concatenated; aligned to
+#             64 bytes after the header
+#
+
+class SketchHashCache:
+    """
+    A directory of downsampled sketch hashes, with least-recently-used
+    eviction of whole segment files once they exceed 'max_size' bytes.
+
+    get() returns a memory-mapped sorted uint64 array; add() buffers new
+    entries, which are written out as a new segment by flush() (and
+    whenever SKETCH_CACHE_SEGMENT_SIZE bytes are pending). Separate
+    processes may share a cache directory, as each writes its own
+    segments; evict() first compacts the small segments they leave
+    behind, so that at most one segment is smaller than
+    SKETCH_CACHE_SEGMENT_SIZE.
+    """
+    def __init__(self, cache_dir, *, max_size=None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+        self._index = None
+        self._segments = {}
+        self._used = set()
+        self._pending = {}
+        self._pending_size = 0
+
+    @classmethod
+    def from_args(cls, args):
+        "Create a cache from the --hash-cache options, or return None."
+        if not args.hash_cache:
+            return None
+        return cls(args.hash_cache,
+                   max_size=int(args.hash_cache_size * 1024**2))
+
+    @staticmethod
+    def add_args(p):
+        "Add the --hash-cache and --hash-cache-size options to an argparse parser."
+        p.add_argument('--hash-cache', default=None,
+                       help="cache the downsampled hashes of each sketch in this directory, and reuse them in later scans")
+        p.add_argument('--hash-cache-size', type=float, default=10240,
+                       help="with --hash-cache, evict least recently used hashes to keep the cache under this many MB (default: 10240)")
+
+    @staticmethod
+    def key(md5, ksize, scaled):
+        return f'{md5}:{int(ksize)}:{int(scaled)}'
+
+    def _segment_paths(self):
+        return [ os.path.join(self.cache_dir, name)
+                 for name in os.listdir(self.cache_dir)
+                 if name.endswith('.hashes') ]
+
+    def _load_index(self):
+        if self._index is None:
+            self._index = {}
+            self._segments = {}
+            for path in self._segment_paths():
+                try:
+                    with open(path, 'rb') as fp:
+                        if fp.read(len(SKETCH_CACHE_MAGIC)) != SKETCH_CACHE_MAGIC:
+                            continue
+                        header_len = int(numpy.frombuffer(fp.read(8),
+                                                          dtype='<u8')[0])
+                        header = json.loads(fp.read(header_len))
+                except FileNotFoundError:  # evicted by another process
+                    continue
+                if header['version'] != SKETCH_CACHE_VERSION:
+                    continue
+
+                data_start = _align(len(SKETCH_CACHE_MAGIC) + 8 + header_len)
+                self._segments[path] = [data_start, header['size'], None]
+                for key, (offset, length) in header['index'].items():
+                    self._index[key] = (path, offset, length)
+        return self._index
+
+    def _map(self, path):
+        segment = self._segments[path]
+        data_start, size, data = segment
+        if data is None:
+            if size:
+                data = numpy.memmap(path, dtype='<u8', mode='r',
+                                    offset=data_start, shape=(size,))
+            else:
+                data = numpy.zeros(0, dtype='<u8')
+            segment[2] = data
+        return data
+
+    def get(self, md5, ksize, scaled):
+        "Return the cached hashes of a sketch, or None if not cached."
+        key = self.key(md5, ksize, scaled)
+        if key in self._pending:
+            return self._pending[key]
+
+        entry = self._load_index().get(key)
+        if entry is None:
+            return None
+        path, offset, length = entry
+        try:
+            data = self._map(path)
+        except FileNotFoundError:  # evicted by another process
+            return None
+
+        self._used.add(path)
+        return data[offset:offset + length]
+
+    def add(self, md5, ksize, scaled, hashes):
+        "Add the sorted hashes of a sketch, to be written on flush()."
+        key = self.key(md5, ksize, scaled)
+        if key in self._pending or key in self._load_index():
+            return
+
+        hashes = numpy.asarray(hashes, dtype='<u8')
+        self._pending[key] = hashes
+        self._pending_size += hashes.nbytes
+        if self._pending_size >= SKETCH_CACHE_SEGMENT_SIZE:
+            self.flush()
+
+    def flush(self):
+        "Write pending entries to a new segment, and record segment use."
+        for path in self._used:
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                pass
+        self._used.clear()
+        if not self._pending:
+            return
+
+        index = {}
+        offset = 0
+        for key, hashes in self._pending.items():
+            index[key] = [offset, len(hashes)]
+            offset += len(hashes)
+        header = dict(version=SKETCH_CACHE_VERSION, size=offset, index=index)
+        header = json.dumps(header).encode('utf-8')
+
+        prefix_len = len(SKETCH_CACHE_MAGIC) + 8 + len(header)
+        data_start = _align(prefix_len)
+
+        path = os.path.join(self.cache_dir, uuid.uuid4().hex + '.hashes')
+        with open(path + '.partial', 'wb') as fp:
+            fp.write(SKETCH_CACHE_MAGIC)
+            fp.write(numpy.uint64(len(header)).astype('<u8').tobytes())
+            fp.write(header)
+            fp.write(b'\0' * (data_start - prefix_len))
+            for hashes in self._pending.values():
+                fp.write(hashes.tobytes())
+        os.replace(path + '.partial', path)
+
+        self._segments[path] = [data_start, offset, None]
+        for key, (offset, length) in index.items():
+            self._load_index()[key] = (path, offset, length)
+        self._pending = {}
+        self._pending_size = 0
+
+    def compact(self):
+        "Merge the segments smaller than SKETCH_CACHE_SEGMENT_SIZE."
+        self.flush()
+        self._index = None  # pick up segments written by other processes
+        index = self._load_index()
+        small = set(path for path, (_, size, _) in self._segments.items()
+                    if size * 8 < SKETCH_CACHE_SEGMENT_SIZE)
+        if len(small) < 2:
+            return
+
+        for key, (path, offset, length) in list(index.items()):
+            if path not in small:
+                continue
+            try:
+                hashes = numpy.array(self._map(path)[offset:offset + length])
+            except FileNotFoundError:  # evicted by another process
+                continue
+            self._pending[key] = hashes
+            self._pending_size += hashes.nbytes
+            if self._pending_size >= SKETCH_CACHE_SEGMENT_SIZE:
+                self.flush()
+        self.flush()
+
+        for path in small:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self._index = None
+
+    def evict(self):
+        "Compact, then remove the least recently used segments until under max_size."
+        self.compact()
+        if self.max_size is None:
+            return
+        entries = []
+        for path in self._segment_paths():
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            print(f"evicting cached sketch hashes '{path}'")
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            self._segments.pop(path, None)
+            self._index = None
+
+
+#
+# columnar presence file format:
+#
+# 8 bytes     magic, b'HASHPRES'
+# 8 bytes     little-endian uint64 length of JSON header
+# N bytes     JSON header: version, ksize/scaled/moltype, sample names,
+#             md5sums of scanned sketches, and the dtype/shape/offset of
+#             each array below
+# ...         arrays, each aligned to 64 bytes, offsets relative to the
+#             (aligned) end of the header:
+#   hashvals           <u8, sorted hash values
+#   indptr             <u8, len(hashvals) + 1 CSR offsets into 'indices'
+#   indices            <u2 or <u4, sample indices for each hash; the
+#                      narrower type is used for at most 65536 samples
+#   classify_hashvals  <u8, hash values in the rank classification
+#   classify_types     u1, pangenome rank of each classify_hashvals entry
+#
+
+def _align(n):
+    return (n + _PRESENCE_FILE_ALIGN - 1) // _PRESENCE_FILE_ALIGN * \
+        _PRESENCE_FILE_ALIGN
+
+
+def is_presence_file(filename):
+    "Check if 'filename' is in the columnar presence file format."
+    with open(filename, 'rb') as fp:
+        return fp.read(len(PRESENCE_FILE_MAGIC)) == PRESENCE_FILE_MAGIC
+
+
+def write_presence_file(filename, presence_info):
+    "Write a HashPresenceInformation object in the columnar format."
+    sample_names = presence_info.sample_names
+    index_dtype = '<u2' if len(sample_names) <= 2**16 else '<u4'
+
+    arrays = dict(
+        hashvals=presence_info.hashvals.astype('<u8'),
+        indptr=presence_info.indptr.astype('<u8'),
+        indices=presence_info.indices.astype(index_dtype),
+        classify_hashvals=presence_info.classify_hashvals.astype('<u8'),
+        classify_types=presence_info.classify_types.astype('u1'),
+    )
+
+    array_info = {}
+    offset = 0
+    for name, arr in arrays.items():
+        array_info[name] = dict(dtype=arr.dtype.str, shape=list(arr.shape),
+                                offset=offset)
+        offset = _align(offset + arr.nbytes)
+
+    header = dict(version=PRESENCE_FILE_VERSION,
+                  ksize=presence_info.ksize,
+                  scaled=presence_info.scaled,
+                  moltype=presence_info.moltype,
+                  sample_names=sample_names,
+                  scanned_md5s=presence_info.scanned_md5s,
+                  arrays=array_info)
+    header = json.dumps(header).encode('utf-8')
+
+    prefix_len = len(PRESENCE_FILE_MAGIC) + 8 + len(header)
+    data_start = _align(prefix_len)
+
+    # write to a temporary file & rename, so that an existing file that is
+    # memory-mapped (e.g. when updating a dump in place) is not clobbered.
+    tmp_filename = f"{filename}.tmp.{os.getpid()}"
+    with open(tmp_filename, 'wb') as fp:
+        fp.write(PRESENCE_FILE_MAGIC)
+        fp.write(numpy.uint64(len(header)).astype('<u8').tobytes())
+        fp.write(header)
+        fp.write(b'\0' * (data_start - prefix_len))
+
+        for name, arr in arrays.items():
+            fp.seek(data_start + array_info[name]['offset'])
+            fp.write(arr.tobytes())
+
+    os.replace(tmp_filename, filename)
+
+
+class PresenceFile:
+    """
+    Memory-mapped, read-only access to a columnar presence file.
+
+    Opening the file only reads the header; arrays are mapped lazily and
+    'read' can pull in a slice of hashes without loading the rest.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as fp:
+            magic = fp.read(len(PRESENCE_FILE_MAGIC))
+            if magic != PRESENCE_FILE_MAGIC:
+                raise ValueError(f"'{filename}' is not a presence file")
+            header_len = int(numpy.frombuffer(fp.read(8), dtype='<u8')[0])
+            header = json.loads(fp.read(header_len).decode('utf-8'))
+
+        version = header['version']
+        if version > PRESENCE_FILE_VERSION:
+            raise ValueError(f"'{filename}' has presence file version {version}; only versions <= {PRESENCE_FILE_VERSION} are supported")
+
+        self.version = version
+        self.ksize = header['ksize']
+        self.scaled = header['scaled']
+        self.moltype = header['moltype']
+        self.sample_names = header['sample_names']
+        self.scanned_md5s = header.get('scanned_md5s', [])
+        self._array_info = header['arrays']
+        self._data_start = _align(len(PRESENCE_FILE_MAGIC) + 8 + header_len)
+
+    def _map(self, name):
+        info = self._array_info[name]
+        dtype = numpy.dtype(info['dtype'])
+        shape = tuple(info['shape'])
+        if not numpy.prod(shape):
+            return numpy.empty(shape, dtype=dtype)
+        return numpy.memmap(self.filename, mode='r', dtype=dtype, shape=shape,
+                            offset=self._data_start + info['offset'])
+
+    @property
+    def hashvals(self):
+        return self._map('hashvals')
+
+    @property
+    def indptr(self):
+        return self._map('indptr')
+
+    @property
+    def indices(self):
+        return self._map('indices')
+
+    def __len__(self):
+        return self._array_info['hashvals']['shape'][0]
+
+    def read(self, start=0, stop=None):
+        "Load rows [start, stop) into a HashPresenceInformation object."
+        if stop is None:
+            stop = len(self)
+
+        hashvals = self.hashvals[start:stop]
+        indptr = self.indptr[start:stop + 1].astype(numpy.int64)
+        indices = self.indices[indptr[0]:indptr[-1]]
+        indptr -= indptr[0]
+
+        return HashPresenceInformation(ksize=self.ksize,
+                                       scaled=self.scaled,
+                                       moltype=self.moltype,
+                                       hashvals=hashvals,
+                                       sample_names=self.sample_names,
+                                       indptr=indptr,
+                                       indices=indices,
+                                       scanned_md5s=self.scanned_md5s,
+                                       classify_hashvals=self._map('classify_hashvals'),
+                                       classify_types=self._map('classify_types'))
+
+
+#
+# bulk export: numpy blocks are formatted into large byte chunks and
+# written through (optionally compressed) binary files, rather than one
+# csv.writer row at a time. Output matches csv.writer, with '\r\n' line
+# endings and minimal quoting.
+#
+
+# number of matrix cells, or presence entries, formatted per chunk.
+EXPORT_CHUNK_SIZE = 1_000_000
+
+
+def open_export_file(filename, *, compression=None):
+    """
+    Open 'filename' for binary writing; '-' is stdout. Output is
+    compressed with 'compression' ('gzip' or 'zstd'), or else as given
+    by the filename extension ('.gz' or '.zst').
+    """
+    if filename == '-':
+        return open(sys.stdout.fileno(), 'wb', closefd=False)
+
+    if compression is None:
+        if filename.endswith('.gz'):
+            compression = 'gzip'
+        elif filename.endswith('.zst'):
+            compression = 'zstd'
+
+    if compression == 'gzip':
+        return gzip.open(filename, 'wb', compresslevel=6)
+    elif compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError("zstd compression requires the 'zstandard' package")
+        return zstandard.ZstdCompressor(threads=-1).stream_writer(open(filename, 'wb'))
+    elif compression is not None:
+        raise ValueError(f"unknown compression '{compression}'")
+
+    return open(filename, 'wb')
+
+
+def csv_quote(value):
+    "Format a string as a CSV field, quoting it as csv.writer does."
+    value = str(value)
+    if any(c in value for c in ',"\r\n'):
+        return '"' + value.replace('"', '""') + '"'
+    return value
+
+
+def format_csv_rows(block):
+    """
+    Format the rows of the 2-d numpy array 'block' as CSV, returning bytes.
+
+    Each cell is formatted as str() formats the array element, but only
+    once per distinct value in the block; association matrices have few
+    distinct values.
+    """
+    if not block.size:
+        return b'\r\n' * block.shape[0]
+
+    return _join_csv_cells(_format_cells(block))
+
+
+def _format_cells(block):
+    "Format each element of the array 'block' with str(), once per distinct value."
+    values = numpy.unique(block)
+    value_strs = numpy.array([ str(v) for v in values ], dtype=object)
+    return value_strs[numpy.searchsorted(values, block)]
+
+
+def _join_csv_cells(cells):
+    "Join a 2-d object array of formatted cells into CSV rows, as bytes."
+    lines = map(','.join, cells.tolist())
+    return ('\r\n'.join(lines) + '\r\n').encode('utf-8')
+
+
+def write_matrix_csv(fp, matrix, *, header=None,
+                     chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Write the 2-d array 'matrix' (e.g. a memmap) as CSV to the binary file
+    'fp', 'chunk_size' cells at a time, preceded by the 'header' row.
+    """
+    if header is not None:
+        line = ','.join(csv_quote(x) for x in header) + '\r\n'
+        fp.write(line.encode('utf-8'))
+
+    n_rows = matrix.shape[0]
+    rows_per_chunk = max(1, chunk_size // max(1, matrix.shape[1]))
+    for start in range(0, n_rows, rows_per_chunk):
+        fp.write(format_csv_rows(matrix[start:start + rows_per_chunk]))
+
+
+def write_edge_list_csv(fp, hashvals, matrix, *, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Write the pairs above the diagonal of the sparse similarity 'matrix'
+    as 'hashval_a,hashval_b,jaccard' CSV rows to the binary file 'fp',
+    'chunk_size' pairs at a time.
+    """
+    hashvals = numpy.asarray(hashvals, dtype=numpy.uint64)
+    edges = scipy.sparse.triu(matrix, k=1).tocoo()
+
+    fp.write(b'hashval_a,hashval_b,jaccard\r\n')
+    for start in range(0, edges.nnz, chunk_size):
+        end = start + chunk_size
+        pairs = numpy.column_stack([hashvals[edges.row[start:end]],
+                                    hashvals[edges.col[start:end]]])
+        jaccard = edges.data[start:end].reshape(-1, 1)
+        cells = numpy.hstack([_format_cells(pairs), _format_cells(jaccard)])
+        fp.write(_join_csv_cells(cells))
+
+
+def iter_presence_chunks(presence_info, *, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Yield (hashvals, sample_idx) arrays of the presence entries in
+    'presence_info', in hash order, roughly 'chunk_size' entries at a time.
+    """
+    indptr = presence_info.indptr
+    n_hashes = len(presence_info.hashvals)
+    start = 0
+    while start < n_hashes:
+        # extend the chunk up to chunk_size entries, by at least one hash.
+        stop = numpy.searchsorted(indptr, indptr[start] + chunk_size,
+                                  side='right') - 1
+        stop = min(max(stop, start + 1), n_hashes)
+
+        counts = numpy.diff(indptr[start:stop + 1])
+        hashvals = numpy.repeat(presence_info.hashvals[start:stop], counts)
+        sample_idx = presence_info.indices[indptr[start]:indptr[stop]]
+        yield hashvals, sample_idx
+        start = stop
+
+
+def write_presence_csv(fp, presence_info, *, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Write the long-form presence table of 'presence_info', as CSV with
+    columns query_name (sample), match_name (hashval), presence, to the
+    binary file 'fp'. Returns the number of entries written.
+    """
+    fp.write(b'query_name,match_name,presence\r\n')
+    names = numpy.array([ csv_quote(n) + ',' for n in presence_info.sample_names ],
+                        dtype=object)
+
+    n_written = 0
+    for hashvals, sample_idx in iter_presence_chunks(presence_info,
+                                                     chunk_size=chunk_size):
+        hash_strs = numpy.char.add(hashvals.astype(str), ',1')
+        lines = map(str.__add__, names[sample_idx].tolist(), hash_strs.tolist())
+        fp.write(('\r\n'.join(lines) + '\r\n').encode('utf-8'))
+        n_written += len(hashvals)
+
+    return n_written
+
+
+def write_presence_parquet(filename, presence_info, *,
+                           chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Write the long-form presence table of 'presence_info' to the Parquet
+    file 'filename', one row group per chunk; query_name is dictionary
+    encoded. Requires pyarrow. Returns the number of entries written.
+    """
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ValueError("Parquet output requires the 'pyarrow' package")
+
+    sample_names = pyarrow.array(presence_info.sample_names,
+                                 type=pyarrow.string())
+    schema = pyarrow.schema([('query_name',
+                              pyarrow.dictionary(pyarrow.int32(),
+                                                 pyarrow.string())),
+                             ('match_name', pyarrow.uint64()),
+                             ('presence', pyarrow.uint8())])
+
+    n_written = 0
+    with pyarrow.parquet.ParquetWriter(filename, schema) as writer:
+        for hashvals, sample_idx in iter_presence_chunks(presence_info,
+                                                         chunk_size=chunk_size):
+            query_name = pyarrow.DictionaryArray.from_arrays(
+                sample_idx.astype(numpy.int32), sample_names)
+            presence = numpy.ones(len(hashvals), dtype=numpy.uint8)
+            table = pyarrow.Table.from_arrays([query_name, hashvals, presence],
+                                              schema=schema)
+            writer.write_table(table)
+            n_written += len(hashvals)
+
+    return n_written
+
+
+#
+# run instrumentation: stage timings, run reports, profiling and progress.
+#
+
+def _format_duration(seconds):
+    "Format a number of seconds as h:mm:ss."
+    seconds = int(round(seconds))
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+def _peak_rss_mb():
+    """
+    Peak resident set size so far, in MB, of this process and of the
+    largest finished child process (e.g. pool workers).
+    """
+    # ru_maxrss is in KB on Linux, and in bytes on macOS.
+    scale = 1024**2 if sys.platform == 'darwin' else 1024
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return peak / scale
+
+
+def _cpu_time():
+    "CPU time used so far by this process and its finished children."
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+class ProgressBar:
+    """
+    Report progress through 'total' items (if known) on stderr, with the
+    rate and the estimated time remaining.
+
+    On a terminal the bar is redrawn in place; otherwise, e.g. in a log
+    file, a line is printed at most every 'interval' seconds.
+    """
+    width = 20
+
+    def __init__(self, total=None, *, desc='progress', unit='items',
+                 interval=None, file=None):
+        self.total = total
+        self.desc = desc
+        self.unit = unit
+        self.file = file or sys.stderr
+        self.is_tty = self.file.isatty()
+        if interval is None:
+            interval = 0.2 if self.is_tty else 10
+        self.interval = interval
+        self.n = 0
+        self.start_time = self.last_time = time.monotonic()
+        self._line_len = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def update(self, n=1):
+        self.n += n
+        now = time.monotonic()
+        if now - self.last_time >= self.interval:
+            self.last_time = now
+            self._draw(now)
+
+    def _draw(self, now):
+        elapsed = now - self.start_time
+        rate = self.n / elapsed if elapsed > 0 else 0
+        if self.total:
+            frac = min(self.n / self.total, 1)
+            bar = '#' * int(frac * self.width)
+            line = f"{self.desc}: [{bar:<{self.width}}] {self.n}/{self.total} {self.unit} ({frac:.0%}), {rate:.1f} {self.unit}/s, {_format_duration(elapsed)} elapsed"
+            if rate > 0 and self.n < self.total:
+                line += f", ~{_format_duration((self.total - self.n) / rate)} left"
+        else:
+            line = f"{self.desc}: {self.n} {self.unit}, {rate:.1f} {self.unit}/s, {_format_duration(elapsed)} elapsed"
+
+        if self.is_tty:
+            self.file.write('\r' + line.ljust(self._line_len))
+            self._line_len = len(line)
+        else:
+            self.file.write(line + '\n')
+        self.file.flush()
+
+    def close(self):
+        self._draw(time.monotonic())
+        if self.is_tty:
+            self.file.write('\n')
+            self.file.flush()
+
+
+class RunReport:
+    """
+    Record wall-clock time, CPU time, peak memory and throughput for the
+    consecutive stages of a script run (loading, scanning, filtering,
+    matrix building, clustering, plotting, writing...).
+
+    Call begin() at the start of each stage, count() to record the items
+    processed, and close() at the end, which prints a summary and writes
+    the report to 'filename' as JSON, or as CSV if it ends in '.csv'.
+    If 'profile' is a filename, the run is also profiled with cProfile
+    (saved in pstats format), or with pyinstrument if it ends in '.html'.
+    """
+    def __init__(self, script, *, filename=None, profile=None):
+        self.script = script
+        self.argv = list(sys.argv)
+        self.filename = filename
+        self.stages = []
+        self._current = None
+        self.started = time.time()
+        self._start = (time.monotonic(), _cpu_time())
+
+        self.profile = profile
+        self._profiler = None
+        if profile and profile.endswith('.html'):
+            try:
+                import pyinstrument
+            except ImportError:
+                raise ValueError("HTML profiles require the 'pyinstrument' package")
+            self._profiler = pyinstrument.Profiler()
+            self._profiler.start()
+        elif profile:
+            import cProfile
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+
+    @classmethod
+    def from_args(cls, args, script=None):
+        "Create a report from the --report and --profile options."
+        script = script or os.path.basename(sys.argv[0])
+        return cls(script, filename=args.report, profile=args.profile)
+
+    @staticmethod
+    def add_args(p):
+        "Add the --report and --profile options to an argparse parser."
+        p.add_argument('--report', default=None,
+                       help="write per-stage timings, peak memory and throughput to this JSON (or .csv) file")
+        p.add_argument('--profile', default=None,
+                       help="profile the run with cProfile and save the stats to this file (or with pyinstrument, if it ends in .html)")
+
+    def begin(self, name):
+        "End the current stage, if any, and start stage 'name'."
+        self._end_stage()
+        self._current = dict(stage=name, items=None, unit=None,
+                             _start=(time.monotonic(), _cpu_time()))
+
+    def count(self, n, unit):
+        "Record that the current stage processed 'n' items of 'unit'."
+        self._current['items'] = (self._current['items'] or 0) + n
+        self._current['unit'] = unit
+
+    def _end_stage(self):
+        stage = self._current
+        if stage is None:
+            return
+        wall_start, cpu_start = stage.pop('_start')
+        stage['wall_time_s'] = round(time.monotonic() - wall_start, 3)
+        stage['cpu_time_s'] = round(_cpu_time() - cpu_start, 3)
+        stage['peak_rss_mb'] = round(_peak_rss_mb(), 1)
+        stage['rate'] = None
+        if stage['items'] is not None and stage['wall_time_s'] > 0:
+            stage['rate'] = round(stage['items'] / stage['wall_time_s'], 1)
+        self.stages.append(stage)
+        self._current = None
+
+    def summary(self):
+        "Return the report as a dictionary."
+        wall_start, cpu_start = self._start
+        return dict(script=self.script,
+                    argv=self.argv,
+                    started=time.strftime('%Y-%m-%dT%H:%M:%S',
+                                          time.localtime(self.started)),
+                    wall_time_s=round(time.monotonic() - wall_start, 3),
+                    cpu_time_s=round(_cpu_time() - cpu_start, 3),
+                    peak_rss_mb=round(_peak_rss_mb(), 1),
+                    stages=self.stages)
+
+    def close(self):
+        "End the run: stop profiling, print a summary and write the report."
+        self._end_stage()
+        if self._profiler is not None:
+            if self.profile.endswith('.html'):
+                self._profiler.stop()
+                with open(self.profile, 'w') as fp:
+                    fp.write(self._profiler.output_html())
+            else:
+                self._profiler.disable()
+                self._profiler.dump_stats(self.profile)
+            print(f"saved profile to '{self.profile}'")
+            self._profiler = None
+
+        summary = self.summary()
+        print(f"run took {_format_duration(summary['wall_time_s'])} ({summary['cpu_time_s']:.1f}s CPU), peak memory {summary['peak_rss_mb']:.0f} MB:")
+        for stage in self.stages:
+            line = f"\t{stage['stage']}: {stage['wall_time_s']:.1f}s ({stage['cpu_time_s']:.1f}s CPU)"
+            if stage['rate'] is not None:
+                line += f", {stage['items']} {stage['unit']} at {stage['rate']:.1f}/s"
+            print(line)
+
+        if self.filename:
+            print(f"writing run report to '{self.filename}'")
+            if self.filename.endswith('.csv'):
+                fieldnames = ['script', 'stage', 'wall_time_s', 'cpu_time_s',
+                              'peak_rss_mb', 'items', 'unit', 'rate']
+                with open(self.filename, 'w', newline='') as fp:
+                    w = csv.DictWriter(fp, fieldnames=fieldnames)
+                    w.writeheader()
+                    for stage in self.stages:
+                        w.writerow(dict(stage, script=self.script))
+                    w.writerow(dict(script=self.script, stage='total',
+                                    wall_time_s=summary['wall_time_s'],
+                                    cpu_time_s=summary['cpu_time_s'],
+                                    peak_rss_mb=summary['peak_rss_mb']))
+            else:
+                with open(self.filename, 'w') as fp:
+                    json.dump(summary, fp, indent=2)
+                    fp.write('\n')
@@ -0,0 +1,38 @@
+#! /usr/bin/env python
+"""
+Merge several hash presence dumps, e.g. built from shards of a sample set.
+"""
+import sys
+import argparse
+
+from hash_presence_lib import HashPresenceInformation, RunReport
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('presence_dumps', nargs='+')
+    p.add_argument('-o', '--output', required=True)
+    RunReport.add_args(p)
+    args = p.parse_args()
+
+    report = RunReport.from_args(args)
+    report.begin('merge')
+    presence_info = None
+    for filename in args.presence_dumps:
+        this_info = HashPresenceInformation.load_from_file(filename)
+        print(f"loaded {len(this_info)} hashes across {len(this_info.sample_names)} samples from '{filename}'")
+
+        if presence_info is None:
+            presence_info = this_info
+        else:
+            presence_info = presence_info.merge(this_info)
+
+    print(f"merged: {len(presence_info)} hashes across {len(presence_info.sample_names)} samples; {len(presence_info.scanned_md5s)} sketches scanned.")
+    print(f"saving to '{args.output}'")
+    report.begin('write')
+    presence_info.save_to_file(args.output)
+    report.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())